@@ -0,0 +1,82 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class ResultCache(object):
+	def __init__(self, capacity = 1024, ttl = None):
+		self._capacity = capacity
+		self._ttl = ttl
+		self._entries = OrderedDict()
+		# key -> (value, expiry, targets), least recently used first
+		self._targets = {}
+		# id of target -> keys, targets are kept alive by entries
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	@classmethod
+	def targets(cls, function):
+		owner = getattr(function, '__self__', None)
+		target = getattr(function, '__func__', function)
+		return (owner, target) if owner is not None else (target,)
+
+	def lookup(self, key):
+		if key is None:
+			return False, None
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is None or (entry[1] is not None and entry[1] < time.time()):
+				if entry is not None:
+					self._forget(key, entry)
+				self.misses += 1
+				return False, None
+			self._entries[key] = entry
+			self.hits += 1
+			return True, entry[0]
+
+	def remember(self, key, function, value):
+		if key is None:
+			return
+		expiry = time.time() + self._ttl if self._ttl is not None else None
+		targets = self.targets(function)
+		with self._lock:
+			previous = self._entries.pop(key, None)
+			if previous is not None:
+				self._forget(key, previous)
+			self._entries[key] = (value, expiry, targets)
+			for target in targets:
+				self._targets.setdefault(id(target), set()).add(key)
+			while len(self._entries) > self._capacity:
+				oldest = next(iter(self._entries))
+				self._forget(oldest, self._entries.pop(oldest))
+				self.evictions += 1
+
+	def invalidate(self, target = None):
+		with self._lock:
+			if target is None:
+				self._entries.clear()
+				self._targets.clear()
+				return
+			for key in list(self._targets.get(id(target), ())):
+				self._forget(key, self._entries.pop(key))
+
+	def _forget(self, key, entry):
+		for target in entry[2]:
+			keys = self._targets[id(target)]
+			keys.discard(key)
+			if not keys:
+				del self._targets[id(target)]
+
+	def stats(self):
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+			'size': len(self._entries),
+		}
+
+	def __len__(self):
+		return len(self._entries)
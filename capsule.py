@@ -1,4 +1,5 @@
 import uuid
+import operator
 
 from types import NoneType
 
@@ -13,6 +14,9 @@ class Capsule(Serializable):
 	
 	@classmethod
 	def wrap(cls, obj):
+		if isinstance(obj, Capsule):
+			# constructed containers hold capsules, already wrapped
+			return obj
 		for _serial, subclass in cls._registry.iteritems():
 			if subclass.can_wrap(obj.__class__):
 				return subclass.wrap(obj)
@@ -190,6 +194,107 @@ class NoneCapsule(Capsule):
 	def actual_value(self, _actual):
 		return None
 
+class AttributeCapsule(Capsule):
+	serial = 'attribute'
+
+	def __init__(self, name):
+		Capsule.__init__(self)
+		self._name = name
+
+	@classmethod
+	def can_wrap(cls, object_class):
+		from remoteable.client import Attribute
+		return issubclass(object_class, Attribute)
+
+	@classmethod
+	def wrap(cls, obj):
+		return cls(obj.name)
+
+	@classmethod
+	def build(cls, data):
+		return cls(data['name'])
+
+	def data(self):
+		return {'name': self._name}
+
+	def proxy_value(self, _proxy):
+		from remoteable.client import Attribute
+		return Attribute(self._name)
+
+	def actual_value(self, _actual):
+		return operator.attrgetter(self._name)
+
+class MethodCapsule(Capsule):
+	serial = 'method'
+
+	def __init__(self, name, args, kwargs):
+		Capsule.__init__(self)
+		self._name = name
+		self._args = args
+		self._kwargs = kwargs
+
+	@classmethod
+	def can_wrap(cls, object_class):
+		from remoteable.client import Method
+		return issubclass(object_class, Method)
+
+	@classmethod
+	def wrap(cls, obj):
+		return cls(obj.name, Capsule.wrap(obj.args), Capsule.wrap(obj.kwargs))
+
+	@classmethod
+	def build(cls, data):
+		return cls(data['name'], Capsule.construct(data['args']),
+				   Capsule.construct(data['kwargs']))
+
+	def data(self):
+		return {
+			'name': self._name,
+			'args': self._args.serialized(),
+			'kwargs': self._kwargs.serialized(),
+		}
+
+	def proxy_value(self, proxy):
+		from remoteable.client import Method
+		return Method(self._name, *self._args.proxy_value(proxy),
+					  **self._kwargs.proxy_value(proxy))
+
+	def actual_value(self, actual):
+		return operator.methodcaller(self._name,
+									 *self._args.actual_value(actual),
+									 **self._kwargs.actual_value(actual))
+
+class CallbackCapsule(Capsule):
+	serial = 'callback'
+
+	def __init__(self, id):
+		Capsule.__init__(self)
+		self._id = id
+
+	@classmethod
+	def can_wrap(cls, object_class):
+		from remoteable.client import Callback
+		return issubclass(object_class, Callback)
+
+	@classmethod
+	def wrap(cls, obj):
+		obj.retain()
+		return cls(obj.id)
+
+	@classmethod
+	def build(cls, data):
+		return cls(uuid.UUID(hex = data['id']))
+
+	def data(self):
+		return {'id': self._id.hex}
+
+	def proxy_value(self, _proxy):
+		from remoteable.client import Callback
+		return Callback.lookup(self._id)
+
+	def actual_value(self, actual):
+		return actual.callback(self._id)
+
 HandleCapsule.register()
 IntegerCapsule.register()
 BooleanCapsule.register()
@@ -200,3 +305,6 @@ TupleCapsule.register()
 SetCapsule.register()
 DictionaryCapsule.register()
 NoneCapsule.register()
+AttributeCapsule.register()
+MethodCapsule.register()
+CallbackCapsule.register()
@@ -0,0 +1,209 @@
+import sys
+import json
+import bisect
+import time
+import socket
+import logging
+import argparse
+import importlib
+import threading
+
+from remoteable.transport import Channel, ConnectionClosed
+from remoteable.response import handle_ids
+
+
+class Recorder(object):
+	# append-only log, one JSON line per command: t - time received,
+	# f - time finished, c - connection, d - command, h - handles created
+	def __init__(self, path):
+		self._file = open(path, 'a')
+		self._lock = threading.Lock()
+
+	def record(self, received, connection, data, response):
+		line = json.dumps({
+			't': received,
+			'f': time.time(),
+			'c': connection,
+			'd': data,
+			'h': handle_ids(response),
+		}, separators = (',', ':'))
+		with self._lock:
+			self._file.write(line + '\n')
+
+	def flush(self):
+		with self._lock:
+			self._file.flush()
+
+	def close(self):
+		with self._lock:
+			self._file.close()
+
+
+def read_log(path):
+	with open(path) as log:
+		return [json.loads(line) for line in log if line.strip()]
+
+
+class Replayer(object):
+	def __init__(self, address, records, speed = 1.0):
+		self._address = address
+		self._records = sorted(records, key = lambda record: record['t'])
+		self._speed = speed
+		# None replays as fast as possible
+		self._ids = {}
+		# recorded handle id -> id given by replayed server
+		self._produced = set()
+		for record in self._records:
+			self._produced.update(record['h'])
+		# command waits for all commands finished before it was received,
+		# so effects of other connections are replayed in recorded order
+		finished = [record.get('f', record['t']) for record in self._records]
+		self._finish_order = sorted(range(len(finished)),
+									key = finished.__getitem__)
+		self._finished = [finished[index] for index in self._finish_order]
+		self._done = set()
+		self._frontier = 0
+		self._condition = threading.Condition()
+		self._samples = []
+		self._logger = logging.getLogger('replay.%s:%s' % address)
+
+	def run(self):
+		connections = {}
+		for index, record in enumerate(self._records):
+			connections.setdefault(record['c'], []).append((index, record))
+		started = time.time()
+		workers = [threading.Thread(target = self.replay,
+									args = (records, started))
+				   for records in connections.itervalues()]
+		for worker in workers:
+			worker.start()
+		for worker in workers:
+			worker.join()
+		return self.report(time.time() - started)
+
+	def replay(self, records, started):
+		channel = Channel(socket.create_connection(self._address))
+		origin = self._records[0]['t'] if self._records else 0
+		try:
+			for index, record in records:
+				self.wait_for(bisect.bisect_right(self._finished, record['t']))
+				if self._speed:
+					delay = started + (record['t'] - origin) / self._speed \
+						- time.time()
+					if delay > 0:
+						time.sleep(delay)
+				data = self.remap(record['d'])
+				sent = time.time()
+				channel.send(data)
+				response = self.receive(channel)
+				self._samples.append((time.time() - sent,
+									  response.get('serial', 'error')))
+				self.learn(index, record['h'], handle_ids(response))
+		except (ConnectionClosed, socket.error):
+			self._logger.warning("connection closed by server", exc_info = True)
+		finally:
+			channel.close()
+			# commands not replayed must not hold back other connections
+			for index, _record in records:
+				if index not in self._done:
+					self.learn(index, [], [])
+
+	def receive(self, channel):
+		while True:
+			data, control = channel.receive()
+			if not control:
+				return data
+			if data.get('control') == 'callback' and data['reply']:
+				# recorded client is not here to answer
+				channel.send({
+					'control': 'callback-result',
+					'call': data['call'],
+					'response': {'serial': 'error-execution',
+								 'class': 'exceptions.RuntimeError',
+								 'text': 'Callback not available in replay'},
+				}, control = True)
+
+	def remap(self, data):
+		if isinstance(data, dict):
+			remapped = dict((key, self.remap(value))
+							for key, value in data.iteritems())
+			if isinstance(data.get('id'), basestring) \
+					and data['id'] in self._produced:
+				remapped['id'] = self._ids.get(data['id'], data['id'])
+			return remapped
+		if isinstance(data, list):
+			return [self.remap(value) for value in data]
+		return data
+
+	def wait_for(self, count):
+		with self._condition:
+			while self._frontier < count:
+				self._condition.wait()
+
+	def learn(self, index, recorded, replayed):
+		with self._condition:
+			for old, new in zip(recorded, replayed):
+				self._ids[old] = new
+			self._done.add(index)
+			while self._frontier < len(self._finish_order) \
+					and self._finish_order[self._frontier] in self._done:
+				self._frontier += 1
+			self._condition.notify_all()
+
+	def report(self, elapsed):
+		latencies = sorted(latency for latency, _serial in self._samples)
+		errors = sum(1 for _latency, serial in self._samples
+					 if serial.startswith('error') or serial == 'busy')
+
+		def percentile(fraction):
+			if not latencies:
+				return 0.0
+			return latencies[min(len(latencies) - 1,
+								 int(len(latencies) * fraction))]
+
+		return {
+			'commands': len(self._samples),
+			'errors': errors,
+			'elapsed': elapsed,
+			'throughput': len(self._samples) / elapsed if elapsed else 0.0,
+			'p50': percentile(0.50),
+			'p90': percentile(0.90),
+			'p99': percentile(0.99),
+		}
+
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(
+		description = "Replay recorded commands against RemotingServer")
+	parser.add_argument('log')
+	parser.add_argument('--host', default = 'localhost')
+	parser.add_argument('--port', type = int, default = 3000)
+	parser.add_argument('--setup', default = None,
+						help = "module:function starting fresh local server "
+						"on given address with the recorded exports")
+	parser.add_argument('--speed', type = float, default = 1.0,
+						help = "1 replays at original pace, 10 ten times faster")
+	parser.add_argument('--max-speed', action = 'store_true',
+						help = "replay as fast as possible")
+	arguments = parser.parse_args(argv)
+	logging.basicConfig(level = logging.WARNING)
+
+	address = (arguments.host, arguments.port)
+	if arguments.setup is not None:
+		module_name, function_name = arguments.setup.split(':')
+		getattr(importlib.import_module(module_name), function_name)(address)
+	speed = None if arguments.max_speed else arguments.speed
+	report = Replayer(address, read_log(arguments.log), speed).run()
+	sys.stdout.write(("%(commands)d commands in %(elapsed).2fs, "
+					  "%(throughput).1f/s, errors %(errors)d\n"
+					  "p50 %(p50_ms).2fms p90 %(p90_ms).2fms "
+					  "p99 %(p99_ms).2fms\n") % dict(
+						  report,
+						  p50_ms = report['p50'] * 1000,
+						  p90_ms = report['p90'] * 1000,
+						  p99_ms = report['p99'] * 1000))
+	return report
+
+
+if __name__ == '__main__':
+	main()
@@ -2,46 +2,62 @@
 from remoteable.capsule import Capsule
 from remoteable.command import FetchCommand, StoreCommand
 
+import json
+import time
+import uuid
+import random
+import select
 import socket
 import logging
-import json
+
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from remoteable.tracing import NULL_SPAN
+from remoteable.transport import Channel, Compressor, ConnectionClosed
+from remoteable.response import BusyResponse, ServerBusyError, DeadlineExceededError
+from remoteable.response import EvaluationResponse, ExecutionErrorResponse
 
 from remoteable.command import ExecuteCommand, GetAttributeCommand, SetAttributeCommand, GetItemCommand, SetItemCommand, OperatorCommand, EvaluateCommand, ReleaseCommand 
+from remoteable.command import MethodCommand, DescribeCommand
+from remoteable.command import CollectCommand, IterateCommand, ChunkCommand
+from remoteable.command import AttributeEvaluateCommand, SnapshotCommand
+from remoteable.command import LengthCommand, ContainsCommand, KeysCommand, ItemsCommand
+from remoteable.command import SliceCommand, GetManyCommand, SetManyCommand
+from remoteable.command import IntrospectCommand, WriteBatchCommand
+from remoteable.command import ProfileCommand, ProfileReportCommand
 
 
 class RemoteHandle(object):
-	__slots__ = ('_proxy', '_id')
+	__slots__ = ('_proxy', '_id', '_type', '_cacheable')
 
-	def __init__(self, proxy, id):
+	def __init__(self, proxy, id, type = None, cacheable = False):
 		self._proxy = proxy
 		self._id = id
+		self._type = type
+		self._cacheable = cacheable
 
-	def __iter__(self):
-		command = EvaluateCommand(self._id, 'list')
+	def _evaluate(self, variant):
+		command = EvaluateCommand(self._id, variant)
 		response = command.push(self._proxy)
-		return iter(response.interpret(self._proxy))
+		return response.interpret(self._proxy)
+
+	def __iter__(self):
+		return iter(self._evaluate('list'))
 
 	def __int__(self):
-		command = EvaluateCommand(self._id, 'int')
-		response = command.push(self._proxy)
-		return int(response.interpret(self._proxy))
+		return int(self._evaluate('int'))
 
 	def __bool__(self):
-		command = EvaluateCommand(self._id, 'bool')
-		response = command.push(self._proxy)
-		return bool(response.interpret(self._proxy))
+		return bool(self._evaluate('bool'))
 
 	__nonzero__ = __bool__	
 
 	def __str__(self):
-		command = EvaluateCommand(self._id, 'str')
-		response = command.push(self._proxy)
-		return str(response.interpret(self._proxy))
+		return str(self._evaluate('str'))
 
 	def __unicode__(self):
-		command = EvaluateCommand(self._id, 'unicode')
-		response = command.push(self._proxy)
-		return str(response.interpret(self._proxy))
+		return str(self._evaluate('unicode'))
 
 	def __eq__(self, other):
 		command = OperatorCommand(self._id, Capsule.wrap(other), 'equals')
@@ -60,10 +76,33 @@ class RemoteHandle(object):
 		return response.interpret(self._proxy)
 
 	def __getitem__(self, key):
+		if isinstance(key, slice):
+			return self._proxy.slice(self, key.start, key.stop, key.step,
+									 evaluate = False)
 		command = GetItemCommand(self._id, Capsule.wrap(key))
 		response = command.push(self._proxy)
 		return response.interpret(self._proxy)
 
+	def __len__(self):
+		command = LengthCommand(self._id)
+		response = command.push(self._proxy)
+		return response.interpret(self._proxy)
+
+	def __contains__(self, value):
+		command = ContainsCommand(self._id, Capsule.wrap(value))
+		response = command.push(self._proxy)
+		return response.interpret(self._proxy)
+
+	def keys(self):
+		command = KeysCommand(self._id)
+		response = command.push(self._proxy)
+		return response.interpret(self._proxy)
+
+	def items(self):
+		command = ItemsCommand(self._id)
+		response = command.push(self._proxy)
+		return response.interpret(self._proxy)
+
 	def __setitem__(self, key, value):
 		command = SetItemCommand(self._id, Capsule.wrap(key),
 								 Capsule.wrap(value))
@@ -71,12 +110,17 @@ class RemoteHandle(object):
 		return response.interpret(self._proxy)
 
 	def __getattr__(self, name):
+		if isinstance(name, basestring):
+			if self._type is not None and name in self._proxy.describe(self):
+				return RemoteMethod(self, name)
+			if self._cacheable and self._proxy.caching():
+				return RemoteAttribute(self, name)
 		command = GetAttributeCommand(self._id, Capsule.wrap(name))
 		response = command.push(self._proxy)
 		return response.interpret(self._proxy)
 
 	def __setattr__(self, name, value):
-		if name in ['_id', '_proxy']:
+		if name in ['_id', '_proxy', '_type', '_cacheable']:
 			return object.__setattr__(self, name, value)
 		command = SetAttributeCommand(self._id, Capsule.wrap(name),
 									  Capsule.wrap(value))
@@ -84,6 +128,7 @@ class RemoteHandle(object):
 		return response.interpret(self._proxy)
 
 	def __del__(self):
+		self._proxy.forget(self._id)
 		command = ReleaseCommand(self._id)
 		response = command.push(self._proxy)
 		return response.interpret(self._proxy)
@@ -92,7 +137,155 @@ class RemoteHandle(object):
 		return "<RemoteHandle (%s)>" % (self._id,)
 
 
+class LazyHandle(RemoteHandle):
+	# attribute of other handle, resolved into real handle only when needed
+	__slots__ = ('_owner', '_name', '_resolved')
+
+	def __init__(self, owner, name):
+		# pylint: disable=W0231
+		# _id is computed, so RemoteHandle.__init__ cannot be used
+		object.__setattr__(self, '_proxy', owner._proxy)
+		object.__setattr__(self, '_type', None)
+		object.__setattr__(self, '_cacheable', False)
+		object.__setattr__(self, '_owner', owner)
+		object.__setattr__(self, '_name', name)
+		object.__setattr__(self, '_resolved', None)
+
+	@property
+	def _id(self):
+		if self._resolved is None:
+			command = GetAttributeCommand(self._owner._id,
+										  Capsule.wrap(self._name))
+			response = command.push(self._proxy)
+			object.__setattr__(self, '_resolved',
+							   response.interpret(self._proxy))
+		return self._resolved._id
+
+	def __del__(self):
+		pass
+		# resolved handle releases itself
+
+
+class RemoteMethod(LazyHandle):
+	__slots__ = ()
+
+	def __call__(self, *args, **kwargs):
+		command = MethodCommand(self._owner._id, Capsule.wrap(self._name),
+								Capsule.wrap(args), Capsule.wrap(kwargs))
+		response = command.push(self._proxy)
+		return response.interpret(self._proxy)
+
+	def __repr__(self):
+		return "<RemoteMethod %s of %r>" % (self._name, self._owner)
+
+
+class RemoteAttribute(LazyHandle):
+	# attribute of cacheable export, evaluated values are cached by proxy
+	__slots__ = ()
+
+	def _evaluate(self, _variant):
+		return self._proxy.evaluate_attribute(self._owner, self._name)
+
+	def __repr__(self):
+		return "<RemoteAttribute %s of %r>" % (self._name, self._owner)
+
+
+class BufferedHandle(RemoteHandle):
+	# assignments are sent in batches, before any other command
+	__slots__ = ('_handle', '_max_pending', '_max_delay')
+
+	def __init__(self, handle, max_pending = 256, max_delay = None):
+		# pylint: disable=W0231
+		# _id is taken from buffered handle, which also releases it
+		object.__setattr__(self, '_proxy', handle._proxy)
+		object.__setattr__(self, '_type', handle._type)
+		object.__setattr__(self, '_cacheable', handle._cacheable)
+		object.__setattr__(self, '_handle', handle)
+		object.__setattr__(self, '_max_pending', max_pending)
+		object.__setattr__(self, '_max_delay', max_delay)
+
+	@property
+	def _id(self):
+		return self._handle._id
+
+	def __setattr__(self, name, value):
+		self._proxy.buffer(self, 'attribute', name, value,
+						   self._max_pending, self._max_delay)
+
+	def __setitem__(self, key, value):
+		self._proxy.buffer(self, 'item', key, value,
+						   self._max_pending, self._max_delay)
+
+	def __del__(self):
+		pass
+
+	def __repr__(self):
+		return "<BufferedHandle of %r>" % (self._handle,)
+
+
+class Attribute(object):
+	__slots__ = ('name',)
+
+	def __init__(self, name):
+		self.name = name
+
+	def __repr__(self):
+		return "<Attribute %s>" % (self.name,)
+
+
+class Method(object):
+	__slots__ = ('name', 'args', 'kwargs')
+
+	def __init__(self, name, *args, **kwargs):
+		self.name = name
+		self.args = args
+		self.kwargs = kwargs
+
+	def __repr__(self):
+		return "<Method %s>" % (self.name,)
+
+
+class Callback(object):
+	# local callable, server calls it back over the connection
+	__slots__ = ('function', 'id')
+
+	_retained = {}
+
+	def __init__(self, function):
+		self.function = function
+		self.id = uuid.uuid4()
+
+	def retain(self):
+		self._retained[self.id] = self
+
+	@classmethod
+	def lookup(cls, id):
+		return cls._retained[id]
+
+	@classmethod
+	def release(cls, id):
+		cls._retained.pop(id, None)
+
+	def __call__(self, *args, **kwargs):
+		return self.function(*args, **kwargs)
+
+	def __repr__(self):
+		return "<Callback %r>" % (self.function,)
+
+
+_nothing = object()
+
 class RemotingProxy(object):
+	def __init__(self, tracer = None, cache = False):
+		self._tracer = tracer
+		self._span = NULL_SPAN
+		self._descriptors = {}
+		self._values = {} if cache else None
+		self._invalidations = 0
+		self._held = []
+		self._writes = OrderedDict()
+		self._buffered = None
+
 	def fetch(self, name):
 		command = FetchCommand(name)
 		response = command.push(self)
@@ -103,17 +296,213 @@ class RemotingProxy(object):
 		response = command.push(self)
 		return response.interpret(self)
 
-	def handle(self, id):
-		return RemoteHandle(self, id)
+	def collect(self, collection, mapper = None, predicate = None,
+				reducer = None, initial = _nothing, evaluate = False):
+		# pylint: disable=W0212
+		# proxy is priviledged to access RemoteHandle _id
+		steps = [Capsule.wrap(step) if step is not None else None
+				 for step in (mapper, predicate, reducer)]
+		if initial is not _nothing:
+			steps.append(Capsule.wrap(initial))
+		command = CollectCommand(collection._id, *steps, evaluate = evaluate)
+		response = command.push(self)
+		return response.interpret(self)
+
+	def map(self, function, collection, evaluate = False):
+		return self.collect(collection, mapper = function, evaluate = evaluate)
+
+	def filter(self, function, collection, evaluate = False):
+		return self.collect(collection, predicate = function,
+							evaluate = evaluate)
+
+	def reduce(self, function, collection, initial = _nothing,
+			   evaluate = False):
+		return self.collect(collection, reducer = function, initial = initial,
+							evaluate = evaluate)
+
+	def stream(self, collection, size = 1000):
+		# pylint: disable=W0212
+		# proxy is priviledged to access RemoteHandle _id
+		iterator = IterateCommand(collection._id).push(self).interpret(self)
+		while True:
+			command = ChunkCommand(iterator._id, size)
+			chunk = command.push(self).interpret(self)
+			for item in chunk:
+				yield item
+			if len(chunk) < size:
+				break
+
+	def snapshot(self, handle, depth = 8, exclude = ()):
+		# pylint: disable=W0212
+		# proxy is priviledged to access RemoteHandle _id
+		command = SnapshotCommand(handle._id, depth, exclude)
+		response = command.push(self)
+		return response.interpret(self)
+
+	def slice(self, handle, start = None, stop = None, step = None,
+			  evaluate = True):
+		# pylint: disable=W0212
+		# proxy is priviledged to access RemoteHandle _id
+		command = SliceCommand(handle._id, Capsule.wrap((start, stop, step)),
+							   evaluate)
+		response = command.push(self)
+		return response.interpret(self)
+
+	def get_many(self, handle, keys):
+		# pylint: disable=W0212
+		# proxy is priviledged to access RemoteHandle _id
+		command = GetManyCommand(handle._id, Capsule.wrap(list(keys)))
+		response = command.push(self)
+		return response.interpret(self)
+
+	def set_many(self, handle, items):
+		# pylint: disable=W0212
+		# proxy is priviledged to access RemoteHandle _id
+		if isinstance(items, dict):
+			items = items.items()
+		command = SetManyCommand(handle._id, Capsule.wrap(list(items)))
+		response = command.push(self)
+		return response.interpret(self)
+
+	def introspect(self, top = 10, sample = 1000):
+		command = IntrospectCommand(top, sample)
+		response = command.push(self)
+		return response.interpret(self)
+
+	def profile(self, duration, mode = 'deterministic', interval = 0.005,
+				top = 20):
+		# profiles all connections of server for given time
+		ProfileCommand(duration, mode, interval).push(self).interpret(self)
+		time.sleep(duration)
+		command = ProfileReportCommand(top)
+		response = command.push(self)
+		return response.interpret(self)
+
+	def handle(self, id, type = None, cacheable = False):
+		return RemoteHandle(self, id, type, cacheable)
+
+	def caching(self):
+		return self._values is not None
+
+	def forget(self, id):
+		# cached attributes of released handle
+		if self._values is not None:
+			self._values.pop(id, None)
+
+	def evaluate_attribute(self, owner, name):
+		# pylint: disable=W0212
+		# proxy is priviledged to access RemoteHandle _id
+		self.poll()
+		values = self._values.get(owner._id, {})
+		if name in values:
+			return values[name]
+		invalidations = self._invalidations
+		command = AttributeEvaluateCommand(owner._id, Capsule.wrap(name))
+		value = command.push(self).interpret(self)
+		if invalidations == self._invalidations:
+			# otherwise value might have been stale already
+			self._values.setdefault(owner._id, {})[name] = value
+		return value
+
+	def control(self, data):
+		kind = data.get('control')
+		if kind == 'invalidate':
+			self._invalidations += 1
+			if self._values is not None:
+				for id in data['handles']:
+					self._values.pop(uuid.UUID(hex = id), None)
+		elif kind == 'callback':
+			self.called_back(data)
+		elif kind == 'callback-release':
+			Callback.release(uuid.UUID(hex = data['callback']))
+
+	def called_back(self, data):
+		args = kwargs = result = None
+		try:
+			callback = Callback.lookup(uuid.UUID(hex = data['callback']))
+			args = Capsule.construct(data['args']).proxy_value(self)
+			kwargs = Capsule.construct(data['kwargs']).proxy_value(self)
+			result = callback(*args, **kwargs)
+			response = EvaluationResponse(Capsule.wrap(result), 'callback')
+			serialized = response.serialized()
+		except Exception, ex:
+			serialized = ExecutionErrorResponse(ex).serialized()
+		if data['reply']:
+			self.send_control({
+				'control': 'callback-result',
+				'call': data['call'],
+				'response': serialized,
+			})
+		# releasing handles passed in and out now would interleave with
+		# request still waiting for its response
+		self._held.append((args, kwargs, result))
+
+	def poll(self):
+		pass
+
+	def describe(self, handle):
+		# pylint: disable=W0212
+		# proxy is priviledged to access RemoteHandle _id and _type
+		if handle._type not in self._descriptors:
+			command = DescribeCommand(handle._id)
+			response = command.push(self)
+			self._descriptors[handle._type] = response.interpret(self)
+		return self._descriptors[handle._type]
+
+	def flush(self):
+		# settles everything deferred before next command is sent
+		held, self._held = self._held, []
+		del held
+		if self._writes:
+			writes, self._writes = self._writes, OrderedDict()
+			command = WriteBatchCommand([write[:4]
+										 for write in writes.itervalues()])
+			command.push(self).interpret(self)
+
+	def buffer(self, handle, kind, name, value, max_pending, max_delay):
+		# pylint: disable=W0212
+		# proxy is priviledged to access RemoteHandle _id
+		name_capsule = Capsule.wrap(name)
+		key = (handle._id, kind, json.dumps(name_capsule.serialized(),
+											sort_keys = True))
+		if not self._writes:
+			self._buffered = time.time()
+		# repeated write moves to the end, it happens after the others
+		self._writes.pop(key, None)
+		self._writes[key] = (handle._id, kind, name_capsule,
+							 Capsule.wrap(value), value, handle._handle)
+		# value and written handle are kept, so that handles are not
+		# released before flush
+		if len(self._writes) >= max_pending or (
+				max_delay is not None
+				and time.time() - self._buffered >= max_delay):
+			self.flush()
+
+	def write_behind(self, handle, max_pending = 256, max_delay = None):
+		return BufferedHandle(handle, max_pending, max_delay)
 
 	def request(self, data):
-		self.send(data)
+		self.send(self._span.attach(data))
 		result = self.receive()
 		return result
 
+	def begin_span(self, serial):
+		if self._tracer is not None:
+			self._span = self._tracer.begin(serial)
+		return self._span
+
+	def end_span(self, result):
+		span, self._span = self._span, NULL_SPAN
+		if span is not NULL_SPAN:
+			span.finish(result.get('trace'))
+			self._tracer.finish(span)
+
 	def send(self, data):
 		raise NotImplementedError(self)
 
+	def send_control(self, data):
+		raise NotImplementedError(self)
+
 	def receive(self):
 		raise NotImplementedError(self)
 
@@ -122,20 +511,154 @@ class RemotingProxy(object):
 
 
 class RemotingClient(RemotingProxy):
-	def __init__(self, server_address):
-		RemotingProxy.__init__(self)
+	def __init__(self, server_address, tracer = None, compression = None,
+				 threshold = 1024, retries = 5, backoff = 0.05,
+				 max_backoff = 2.0, timeout = None, cache = False,
+				 priority = None):
+		RemotingProxy.__init__(self, tracer, cache)
 		self._logger = logging.getLogger('client.%s:%s' % server_address)
-		self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self._socket.connect(server_address)
+		self._address = server_address
+		self._compression = compression
+		self._priority = priority
+		self._threshold = threshold
+		self._retries = retries
+		self._backoff = backoff
+		self._max_backoff = max_backoff
+		self._timeout = timeout
+		self._deadline = None
+		self._socket = None
+		self._channel = None
+		self.connect()
+
+	def connect(self):
+		delays = self.delays()
+		while True:
+			if self._socket is not None:
+				self._socket.close()
+			self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			self._socket.connect(self._address)
+			self._channel = Channel(self._socket, threshold = self._threshold)
+			if self._values is not None:
+				# new connection is not subscribed to any invalidations
+				self._values.clear()
+			if not (self._compression or self._priority) \
+					or self.negotiate(self._compression or [], self._priority):
+				return
+			delay = next(delays, None)
+			if delay is None:
+				raise ServerBusyError("Connection rejected")
+			time.sleep(delay)
+
+	def delays(self):
+		# exponential backoff with full jitter
+		backoff = self._backoff
+		for _attempt in range(self._retries):
+			yield random.uniform(0, backoff)
+			backoff = min(backoff * 2, self._max_backoff)
+
+	def negotiate(self, compression, priority = None):
+		self._channel.send({
+			'control': 'negotiate',
+			'compression': list(compression),
+			'priority': priority,
+		}, control = True)
+		reply, control = self._channel.receive()
+		self._logger.debug("negotiated %s", reply)
+		if not control:
+			# server is busy and refused the connection
+			return False
+		if reply.get('compression') is not None:
+			self._channel.compressor = Compressor.negotiate([reply['compression']])
+		return True
+
+	@contextmanager
+	def deadline(self, timeout):
+		previous = self._deadline
+		deadline = time.time() + timeout
+		if previous is not None:
+			deadline = min(deadline, previous)
+		self._deadline = deadline
+		try:
+			yield
+		finally:
+			self._deadline = previous
+
+	def request(self, data):
+		deadline = self._deadline
+		if self._timeout is not None:
+			deadline = min(deadline or float('inf'),
+						   time.time() + self._timeout)
+		delays = self.delays()
+		while True:
+			if deadline is None:
+				result = RemotingProxy.request(self, data)
+			else:
+				result = self.request_until(data, deadline)
+			if result.get('serial') != BusyResponse.serial:
+				return result
+			delay = next(delays, None)
+			if delay is None:
+				return result
+			if deadline is not None:
+				delay = min(delay, deadline - time.time())
+			self._logger.debug("server busy, retrying in %.3fs", delay)
+			time.sleep(max(delay, 0))
+			if result['reconnect']:
+				self.connect()
+
+	def request_until(self, data, deadline):
+		remaining = deadline - time.time()
+		if remaining <= 0:
+			raise DeadlineExceededError("Deadline expired before sending")
+		self._socket.settimeout(remaining)
+		try:
+			return RemotingProxy.request(self, dict(data, deadline = remaining))
+		except socket.timeout:
+			# late response would be taken for answer to the next request
+			self.connect()
+			raise DeadlineExceededError("Deadline expired waiting for response")
+		finally:
+			self._socket.settimeout(None)
 
 	def send(self, data):
 		self._logger.debug("sending %s", data)
-		self._socket.send(json.dumps(data))
+		frame = self._channel.pack(data)
+		self._span.mark('encode')
+		self._channel.send_frame(frame)
+
+	def send_control(self, data):
+		self._logger.debug("sending control %s", data)
+		self._channel.send(data, control = True)
 
 	def receive(self):
-		result = json.loads(self._socket.recv(65535))
+		flags, payload = self._channel.receive_frame()
+		while flags & Channel.CONTROL:
+			self.control(self._channel.unpack(flags, payload))
+			flags, payload = self._channel.receive_frame()
+		self._span.mark('network')
+		result = self._channel.unpack(flags, payload)
+		self._span.mark('decode')
 		self._logger.debug("received %s", result)
 		return result
 
+	def poll(self):
+		# handles messages pushed by server while no request was pending
+		while select.select([self._socket], [], [], 0)[0]:
+			try:
+				data, control = self._channel.receive()
+			except ConnectionClosed:
+				break
+			if control:
+				self.control(data)
+			else:
+				self._logger.warning("unexpected message %s", data)
+
+	def listen(self, timeout = None):
+		# waits for messages pushed by server, returns False on timeout
+		if not select.select([self._socket], [], [], timeout)[0]:
+			return False
+		self.poll()
+		return True
+
 	def __repr__(self):
 		return "<%s socket(%s)>" % (self.__class__.__name__, self._socket)
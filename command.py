@@ -6,16 +6,25 @@ from remoteable.serializable import Serializable
 
 class Command(Serializable):
 	_registry = {}
+	flushes = True
 
 	def execute(self, actual):
 		raise NotImplementedError(self)
 
 	def push(self, proxy):
-		result = proxy.request(self.serialized())
-		return Response.construct(result)
+		if self.flushes:
+			proxy.flush()
+		span = proxy.begin_span(self.serial)
+		data = self.serialized()
+		span.mark('serialize')
+		result = proxy.request(data)
+		response = Response.construct(result)
+		span.mark('construct')
+		proxy.end_span(result)
+		return response
 
 
-from remoteable.response import AccessErrorResponse, HandleResponse
+from remoteable.response import AccessErrorResponse, HandleResponse, type_name
 
 class FetchCommand(Command):
 	serial = 'fetch'
@@ -36,7 +45,8 @@ class FetchCommand(Command):
 			id = actual.fetch(self._name)
 		except KeyError, ex:
 			return AccessErrorResponse(ex)
-		return HandleResponse(id)
+		obj = actual.access(id)
+		return HandleResponse(id, type_name(obj), actual.is_cacheable(obj))
 
 
 from remoteable.capsule import Capsule
@@ -57,10 +67,11 @@ class StoreCommand(Command):
 
 	def execute(self, actual):
 		try:
-			id = actual.store(self._obj.actual_value(actual))
+			value = self._obj.actual_value(actual)
 		except KeyError, ex:
 			return AccessErrorResponse(ex)
-		return HandleResponse(id)
+		id = actual.store(value)
+		return HandleResponse(id, type_name(value))
 
 
 from remoteable.response import ErrorResponse # TODO
@@ -98,8 +109,11 @@ class GetCommand(Command):
 			result = self.getter(obj, resolved_name)
 		except Exception, ex: # TODO
 			return ErrorResponse(ex)
+		return self.respond(actual, obj, result)
+
+	def respond(self, actual, _obj, result):
 		id = actual.store(result)
-		return HandleResponse(id)
+		return HandleResponse(id, type_name(result))
 
 
 class GetAttributeCommand(GetCommand):
@@ -159,6 +173,7 @@ class SetCommand(Command):
 			self.setter(obj, resolved_name, resolved_value)
 		except Exception, ex: # TODO
 			return ErrorResponse(ex)
+		actual.modified(obj)
 		return EmptyResponse()
 
 
@@ -178,6 +193,55 @@ class SetItemCommand(SetCommand):
 		obj.__setitem__(name, value)
 
 
+class WriteBatchCommand(Command):
+	# buffered attribute and item assignments of many handles, applied in
+	# order until first failure
+	serial = 'write-batch'
+
+	setters = {
+		'attribute': SetAttributeCommand.setter,
+		'item': SetItemCommand.setter,
+	}
+
+	def __init__(self, writes):
+		Command.__init__(self)
+		self._writes = writes
+
+	def data(self):
+		return {
+			'writes': [{
+				'id': id.hex,
+				'kind': kind,
+				'name': name.serialized(),
+				'value': value.serialized(),
+			} for id, kind, name, value in self._writes],
+		}
+
+	@classmethod
+	def build(cls, data):
+		return cls([(uuid.UUID(hex = write['id']), write['kind'],
+					 Capsule.construct(write['name']),
+					 Capsule.construct(write['value']))
+					for write in data['writes']])
+
+	def execute(self, actual):
+		for id, kind, name, value in self._writes:
+			try:
+				obj = actual.access(id)
+				resolved_name = name.actual_value(actual)
+				resolved_value = value.actual_value(actual)
+			except KeyError, ex:
+				return AccessErrorResponse(ex)
+			try:
+				self.setters[kind](obj, resolved_name, resolved_value)
+			#pylint: disable=W0703
+			# all exception should be caught and returned to client
+			except Exception, ex:
+				return ErrorResponse(ex)
+			actual.modified(obj)
+		return EmptyResponse()
+
+
 from remoteable.response import OperationErrorResponse
 
 class OperatorCommand(Command):
@@ -227,7 +291,7 @@ class OperatorCommand(Command):
 		except Exception as ex:
 			return ExecutionErrorResponse(ex)
 		id = actual.store(result)
-		return HandleResponse(id)
+		return HandleResponse(id, type_name(result))
 
 
 from remoteable.response import ExecutionErrorResponse
@@ -259,16 +323,95 @@ class ExecuteCommand(Command):
 			obj = actual.access(self._id)
 		except KeyError, ex:
 			return AccessErrorResponse(ex)
-		unwrapped_args = self._args.actual_value(actual)
-		unwrapped_kwargs = self._kwargs.actual_value(actual)
+		return self.call(actual, obj)
+
+	def call(self, actual, function):
+		key = actual.cache_key(function, self._args, self._kwargs)
+		cached, result = actual.results.lookup(key)
+		if not cached:
+			unwrapped_args = self._args.actual_value(actual)
+			unwrapped_kwargs = self._kwargs.actual_value(actual)
+			try:
+				result = function(*unwrapped_args, **unwrapped_kwargs)
+			#pylint: disable=W0703
+			# all exception should be caught and returned to client
+			except Exception as ex:
+				return ExecutionErrorResponse(ex)
+			actual.results.remember(key, function, result)
+		id = actual.store(result)
+		return HandleResponse(id, type_name(result))
+
+
+from remoteable.response import AttributeErrorResponse
+
+class MethodCommand(ExecuteCommand):
+	serial = 'method-call'
+
+	def __init__(self, id, name, args, kwargs):
+		ExecuteCommand.__init__(self, id, args, kwargs)
+		self._name = name
+
+	def data(self):
+		return dict(ExecuteCommand.data(self), name = self._name.serialized())
+
+	@classmethod
+	def build(cls, data):
+		return cls(uuid.UUID(hex = data['id']),
+				   Capsule.construct(data['name']),
+				   Capsule.construct(data['args']),
+				   Capsule.construct(data['kwargs']))
+
+	def execute(self, actual):
+		try:
+			obj = actual.access(self._id)
+		except KeyError, ex:
+			return AccessErrorResponse(ex)
 		try:
-			result = obj(*unwrapped_args, **unwrapped_kwargs)
+			resolved_name = self._name.actual_value(actual)
+		except KeyError, ex:
+			return AccessErrorResponse(ex)
+		try:
+			method = getattr(obj, resolved_name)
+		except AttributeError, ex:
+			return AttributeErrorResponse(ex)
 		#pylint: disable=W0703
-		# all exception should be caught and returned to client
-		except Exception as ex:
+		# property getters may raise anything
+		except Exception, ex:
 			return ExecutionErrorResponse(ex)
-		id = actual.store(result)
-		return HandleResponse(id)
+		return self.call(actual, method)
+
+
+from remoteable.response import DescriptionResponse
+
+class DescribeCommand(Command):
+	serial = 'describe'
+
+	def __init__(self, id):
+		Command.__init__(self)
+		self._id = id
+
+	def data(self):
+		return {
+			'id': self._id.hex,
+		}
+
+	@classmethod
+	def build(cls, data):
+		return cls(uuid.UUID(hex = data['id']))
+
+	@classmethod
+	def methods(cls, obj):
+		obj_class = getattr(obj, '__class__', type(obj))
+		return sorted(name for name in dir(obj_class)
+					  if not name.startswith('__')
+					  and callable(getattr(obj_class, name, None)))
+
+	def execute(self, actual):
+		try:
+			obj = actual.access(self._id)
+		except KeyError as ex:
+			return AccessErrorResponse(ex)
+		return DescriptionResponse(type_name(obj), self.methods(obj))
 
 
 from remoteable.response import EvaluationResponse
@@ -299,10 +442,391 @@ class EvaluateCommand(Command):
 		return EvaluationResponse(Capsule.wrap(obj), self._variant)
 
 
+class AttributeEvaluateCommand(GetAttributeCommand):
+	serial = 'attribute-evaluate'
+
+	def respond(self, actual, obj, result):
+		try:
+			value = Capsule.wrap(result)
+			value.serialized()
+		except TypeError as ex:
+			return OperationErrorResponse(ex)
+		if actual.is_cacheable(obj):
+			actual.watch(obj, self._id)
+		return EvaluationResponse(value, self.serial)
+
+
+class CollectCommand(Command):
+	serial = 'collect'
+
+	def __init__(self, id, mapper = None, predicate = None, reducer = None,
+				 initial = None, evaluate = False):
+		Command.__init__(self)
+		self._id = id
+		self._mapper = mapper
+		self._predicate = predicate
+		self._reducer = reducer
+		self._initial = initial
+		self._evaluate = evaluate
+
+	def data(self):
+		data = {
+			'id': self._id.hex,
+			'evaluate': self._evaluate,
+		}
+		for key in ('mapper', 'predicate', 'reducer', 'initial'):
+			step = getattr(self, '_' + key)
+			if step is not None:
+				data[key] = step.serialized()
+		return data
+
+	@classmethod
+	def build(cls, data):
+		steps = {}
+		for key in ('mapper', 'predicate', 'reducer', 'initial'):
+			if key in data:
+				steps[key] = Capsule.construct(data[key])
+		return cls(uuid.UUID(hex = data['id']), evaluate = data['evaluate'],
+				   **steps)
+
+	@classmethod
+	def collect(cls, collection, mapper, predicate, reducer, initial):
+		# steps are applied in map, filter, reduce order
+		if mapper is not None:
+			collection = (mapper(item) for item in collection)
+		if predicate is not None:
+			collection = (item for item in collection if predicate(item))
+		if reducer is None:
+			return list(collection)
+		if initial is None:
+			return reduce(reducer, collection)
+		return reduce(reducer, collection, initial[0])
+
+	def execute(self, actual):
+		try:
+			collection = actual.access(self._id)
+		except KeyError as ex:
+			return AccessErrorResponse(ex)
+		try:
+			mapper, predicate, reducer = [
+				step.actual_value(actual) if step is not None else None
+				for step in (self._mapper, self._predicate, self._reducer)]
+			initial = None
+			if self._initial is not None:
+				initial = (self._initial.actual_value(actual),)
+		except KeyError as ex:
+			return AccessErrorResponse(ex)
+		if isinstance(reducer, basestring):
+			try:
+				reducer = OperatorCommand.operators[reducer]
+			except KeyError as ex:
+				return OperationErrorResponse(ex)
+		try:
+			result = self.collect(collection, mapper, predicate, reducer,
+								  initial)
+		#pylint: disable=W0703
+		# all exception should be caught and returned to client
+		except Exception as ex:
+			return ExecutionErrorResponse(ex)
+		if self._evaluate:
+			if reducer is None:
+				value = ContainerCommand.values(actual, result)
+			else:
+				value = actual.wrap(result)
+			return EvaluationResponse(value, self.serial)
+		id = actual.store(result)
+		return HandleResponse(id, type_name(result))
+
+
+class IterateCommand(Command):
+	serial = 'iterate'
+
+	def __init__(self, id):
+		Command.__init__(self)
+		self._id = id
+
+	def data(self):
+		return {
+			'id': self._id.hex,
+		}
+
+	@classmethod
+	def build(cls, data):
+		return cls(uuid.UUID(hex = data['id']))
+
+	def execute(self, actual):
+		try:
+			obj = actual.access(self._id)
+		except KeyError as ex:
+			return AccessErrorResponse(ex)
+		try:
+			iterator = iter(obj)
+		except TypeError as ex:
+			return OperationErrorResponse(ex)
+		id = actual.store(iterator)
+		return HandleResponse(id, type_name(iterator))
+
+
+import itertools
+
+class ChunkCommand(Command):
+	serial = 'chunk'
+
+	def __init__(self, id, size):
+		Command.__init__(self)
+		self._id = id
+		self._size = size
+
+	def data(self):
+		return {
+			'id': self._id.hex,
+			'size': self._size,
+		}
+
+	@classmethod
+	def build(cls, data):
+		return cls(uuid.UUID(hex = data['id']), data['size'])
+
+	def execute(self, actual):
+		try:
+			iterator = actual.access(self._id)
+		except KeyError as ex:
+			return AccessErrorResponse(ex)
+		try:
+			chunk = list(itertools.islice(iterator, self._size))
+		#pylint: disable=W0703
+		# all exception should be caught and returned to client
+		except Exception as ex:
+			return ExecutionErrorResponse(ex)
+		return EvaluationResponse(ContainerCommand.values(actual, chunk),
+								  self.serial)
+
+
+from remoteable.capsule import ListCapsule, TupleCapsule
+
+class ContainerCommand(Command):
+	# container operations, answered in single round trip
+
+	def __init__(self, id, argument = None, evaluate = True):
+		Command.__init__(self)
+		self._id = id
+		self._argument = argument
+		self._evaluate = evaluate
+
+	def data(self):
+		data = {
+			'id': self._id.hex,
+			'evaluate': self._evaluate,
+		}
+		if self._argument is not None:
+			data['argument'] = self._argument.serialized()
+		return data
+
+	@classmethod
+	def build(cls, data):
+		argument = None
+		if 'argument' in data:
+			argument = Capsule.construct(data['argument'])
+		return cls(uuid.UUID(hex = data['id']), argument, data['evaluate'])
+
+	def operate(self, actual, obj, argument):
+		raise NotImplementedError(self)
+
+	@classmethod
+	def values(cls, actual, values):
+		# elements are sent separately, so single unserializable one is
+		# passed as handle without affecting others
+		return ListCapsule([actual.wrap(value) for value in values])
+
+	def execute(self, actual):
+		try:
+			obj = actual.access(self._id)
+		except KeyError as ex:
+			return AccessErrorResponse(ex)
+		try:
+			argument = None
+			if self._argument is not None:
+				argument = self._argument.actual_value(actual)
+		except KeyError as ex:
+			return AccessErrorResponse(ex)
+		try:
+			return self.operate(actual, obj, argument)
+		#pylint: disable=W0703
+		# all exception should be caught and returned to client
+		except Exception as ex:
+			return ExecutionErrorResponse(ex)
+
+
+class LengthCommand(ContainerCommand):
+	serial = 'length'
+
+	def operate(self, _actual, obj, _argument):
+		return EvaluationResponse(Capsule.wrap(len(obj)), self.serial)
+
+
+class ContainsCommand(ContainerCommand):
+	serial = 'contains'
+
+	def operate(self, _actual, obj, argument):
+		return EvaluationResponse(Capsule.wrap(argument in obj), self.serial)
+
+
+class KeysCommand(ContainerCommand):
+	serial = 'keys'
+
+	def operate(self, actual, obj, _argument):
+		return EvaluationResponse(self.values(actual, obj.keys()), self.serial)
+
+
+class ItemsCommand(ContainerCommand):
+	serial = 'items'
+
+	def operate(self, actual, obj, _argument):
+		items = ListCapsule([TupleCapsule((actual.wrap(key), actual.wrap(value)))
+							 for key, value in obj.items()])
+		return EvaluationResponse(items, self.serial)
+
+
+class SliceCommand(ContainerCommand):
+	serial = 'slice'
+
+	def operate(self, actual, obj, argument):
+		result = obj[slice(*argument)]
+		if self._evaluate:
+			return EvaluationResponse(actual.wrap(result), self.serial)
+		id = actual.store(result)
+		return HandleResponse(id, type_name(result))
+
+
+class GetManyCommand(ContainerCommand):
+	serial = 'item-get-many'
+
+	def operate(self, actual, obj, argument):
+		values = [obj[key] for key in argument]
+		return EvaluationResponse(self.values(actual, values), self.serial)
+
+
+class SetManyCommand(ContainerCommand):
+	serial = 'item-set-many'
+
+	def operate(self, actual, obj, argument):
+		for key, value in argument:
+			obj[key] = value
+		actual.modified(obj)
+		return EmptyResponse()
+
+
+from remoteable.response import SnapshotResponse
+from remoteable.snapshot import SnapshotWriter
+
+class SnapshotCommand(Command):
+	serial = 'snapshot'
+
+	def __init__(self, id, depth, exclude = ()):
+		Command.__init__(self)
+		self._id = id
+		self._depth = depth
+		self._exclude = exclude
+
+	def data(self):
+		return {
+			'id': self._id.hex,
+			'depth': self._depth,
+			'exclude': list(self._exclude),
+		}
+
+	@classmethod
+	def build(cls, data):
+		return cls(uuid.UUID(hex = data['id']), data['depth'], data['exclude'])
+
+	def execute(self, actual):
+		try:
+			obj = actual.access(self._id)
+		except KeyError as ex:
+			return AccessErrorResponse(ex)
+		writer = SnapshotWriter(actual, self._exclude)
+		root, nodes = writer.write(obj, self._depth)
+		return SnapshotResponse(root, nodes)
+
+
+class IntrospectCommand(Command):
+	serial = 'introspect'
+
+	def __init__(self, top = 10, sample = 1000):
+		Command.__init__(self)
+		self._top = top
+		self._sample = sample
+
+	def data(self):
+		return {
+			'top': self._top,
+			'sample': self._sample,
+		}
+
+	@classmethod
+	def build(cls, data):
+		return cls(data['top'], data['sample'])
+
+	def execute(self, actual):
+		report = actual.introspect(self._top, self._sample)
+		return EvaluationResponse(Capsule.wrap(report), self.serial)
+
+
+from remoteable.response import ProfileResponse
+
+class ProfileCommand(Command):
+	serial = 'profile'
+
+	def __init__(self, duration, mode, interval = 0.005):
+		Command.__init__(self)
+		self._duration = duration
+		self._mode = mode
+		self._interval = interval
+
+	def data(self):
+		return {
+			'duration': self._duration,
+			'mode': self._mode,
+			'interval': self._interval,
+		}
+
+	@classmethod
+	def build(cls, data):
+		return cls(data['duration'], data['mode'], data['interval'])
+
+	def execute(self, actual):
+		try:
+			actual.profile(self._duration, self._mode, self._interval)
+		except ValueError as ex:
+			return OperationErrorResponse(ex)
+		return EmptyResponse()
+
+
+class ProfileReportCommand(Command):
+	serial = 'profile-report'
+
+	def __init__(self, top = 20):
+		Command.__init__(self)
+		self._top = top
+
+	def data(self):
+		return {'top': self._top}
+
+	@classmethod
+	def build(cls, data):
+		return cls(data['top'])
+
+	def execute(self, actual):
+		return ProfileResponse(actual.profile_report(self._top))
+
+
 from remoteable.response import EmptyResponse
 
 class ReleaseCommand(Command):
 	serial = 'release'
+	# sent from __del__, where error of flushed writes would be lost;
+	# buffered writes keep their handles alive, so order does not matter
+	flushes = False
 
 	def __init__(self, id):
 		Command.__init__(self)
@@ -330,7 +854,25 @@ GetAttributeCommand.register()
 SetAttributeCommand.register()
 GetItemCommand.register()
 SetItemCommand.register()
+WriteBatchCommand.register()
 OperatorCommand.register()
 ExecuteCommand.register()
+MethodCommand.register()
+DescribeCommand.register()
 EvaluateCommand.register()
+AttributeEvaluateCommand.register()
+CollectCommand.register()
+IterateCommand.register()
+ChunkCommand.register()
+SnapshotCommand.register()
+IntrospectCommand.register()
+ProfileCommand.register()
+ProfileReportCommand.register()
+LengthCommand.register()
+ContainsCommand.register()
+KeysCommand.register()
+ItemsCommand.register()
+SliceCommand.register()
+GetManyCommand.register()
+SetManyCommand.register()
 ReleaseCommand.register()
@@ -0,0 +1,284 @@
+import sys
+import time
+import Queue
+import random
+import logging
+import argparse
+import resource
+import threading
+import multiprocessing
+
+from remoteable.server import ThreadedRemotingServer
+from remoteable.client import RemotingClient
+
+
+class Node(object):
+	def __init__(self, value, parent = None):
+		self.value = value
+		self.parent = parent
+		self._children = []
+
+	def child(self, index):
+		return self._children[index]
+
+	def add_child(self, node):
+		node.parent = self
+		self._children.append(node)
+
+
+class Service(object):
+	def compute(self, n):
+		return sum(i * i for i in xrange(n))
+
+	def echo(self, payload):
+		return payload
+
+
+def build_tree(depth, fanout, value = 0):
+	node = Node(value)
+	if depth > 1:
+		for index in range(fanout):
+			node.add_child(build_tree(depth - 1, fanout, value * fanout + index))
+	return node
+
+
+def export_samples(server, depth = 4, fanout = 4):
+	server.export(build_tree(depth, fanout), remote_name = 'tree')
+	server.export(Service(), remote_name = 'service')
+
+
+class Scenarios(object):
+	names = ('fetch', 'call', 'payload', 'churn')
+
+	def __init__(self, client, payload_size = 1000, churn_size = 10,
+				 tree_depth = 4, fanout = 4):
+		self._client = client
+		self._service = client.fetch('service')
+		self._payload = ['item %d' % i for i in range(payload_size)]
+		self._churn_size = churn_size
+		self._tree_depth = tree_depth
+		self._fanout = fanout
+
+	def fetch(self):
+		node = self._client.fetch('tree')
+		for _level in range(self._tree_depth - 1):
+			node = node.child(random.randrange(self._fanout))
+		return int(node.value)
+
+	def call(self):
+		return int(self._service.compute(100))
+
+	def payload(self):
+		return len(list(self._service.echo(self._payload)))
+
+	def churn(self):
+		handles = [self._client.store(i) for i in range(self._churn_size)]
+		del handles
+
+
+def parse_mix(text):
+	mix = []
+	for part in text.split(','):
+		name, _sep, weight = part.partition('=')
+		if name not in Scenarios.names:
+			raise argparse.ArgumentTypeError("unknown scenario %r" % name)
+		mix.append((name, float(weight or 1)))
+	return mix
+
+
+def drive(address, mix, duration, seed, options, results):
+	# single simulated client, samples are (finished, scenario, latency, failed)
+	random.seed(seed)
+	samples = []
+	try:
+		client = RemotingClient(tuple(address))
+		scenarios = Scenarios(client, **options)
+	except Exception:
+		results.put([(time.time(), 'connect', 0.0, True)])
+		return
+	names = [name for name, _weight in mix]
+	weights = [weight for _name, weight in mix]
+	total = sum(weights)
+	deadline = time.time() + duration
+	while time.time() < deadline:
+		pick = random.uniform(0, total)
+		for name, weight in zip(names, weights):
+			pick -= weight
+			if pick <= 0:
+				break
+		started = time.time()
+		try:
+			getattr(scenarios, name)()
+			failed = False
+		#pylint: disable=W0703
+		# failures are counted, not fatal
+		except Exception:
+			failed = True
+		finished = time.time()
+		samples.append((finished, name, finished - started, failed))
+	results.put(samples)
+
+
+def percentile(ordered, fraction):
+	if not ordered:
+		return 0.0
+	return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def rss():
+	try:
+		with open('/proc/self/status') as status:
+			for line in status:
+				if line.startswith('VmRSS:'):
+					return int(line.split()[1]) * 1024
+	except IOError:
+		pass
+	# peak instead of current where /proc is not available
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def summarize(samples, elapsed):
+	latencies = sorted(sample[2] for sample in samples if not sample[3])
+	return {
+		'operations': len(samples),
+		'errors': sum(1 for sample in samples if sample[3]),
+		'throughput': len(latencies) / elapsed if elapsed else 0.0,
+		'p50': percentile(latencies, 0.50),
+		'p90': percentile(latencies, 0.90),
+		'p99': percentile(latencies, 0.99),
+	}
+
+
+def run_level(server, address, clients, duration, mix, options = None,
+			  interval = 1.0, processes = True, report = None):
+	if processes:
+		results = multiprocessing.Queue()
+		spawn = multiprocessing.Process
+	else:
+		results = Queue.Queue()
+		spawn = threading.Thread
+	workers = [spawn(target = drive,
+					 args = (address, mix, duration, random.random(),
+							 options or {}, results))
+			   for _client in range(clients)]
+	started = time.time()
+	for worker in workers:
+		worker.daemon = True
+		worker.start()
+	samples = []
+	resources = []
+	# server side measures, sampled while clients run
+	delivered = 0
+	while delivered < clients:
+		now = time.time()
+		if not resources or now - resources[-1][0] >= interval:
+			resources.append((now, rss(), server.stats()['handles']))
+		alive = any(worker.is_alive() for worker in workers)
+		try:
+			# processes cannot exit before their results are read
+			samples.extend(results.get(timeout = 0.1 if alive else 1.0))
+			delivered += 1
+		except Queue.Empty:
+			if not alive:
+				break
+	for worker in workers:
+		worker.join()
+	elapsed = time.time() - started
+	timeline = []
+	for index in range(int(elapsed // interval) + 1):
+		low, high = started + index * interval, started + (index + 1) * interval
+		bucket = [sample for sample in samples if low <= sample[0] < high]
+		measured = [entry for entry in resources if low <= entry[0] < high]
+		if not bucket and not measured:
+			continue
+		line = summarize(bucket, min(interval, elapsed - index * interval))
+		line['time'] = index * interval
+		line['rss'] = measured[-1][1] if measured else None
+		line['handles'] = measured[-1][2] if measured else None
+		timeline.append(line)
+		if report is not None:
+			report(line)
+	summary = summarize(samples, elapsed)
+	summary['clients'] = clients
+	summary['rss'] = rss()
+	summary['handles'] = server.stats()['handles']
+	summary['timeline'] = timeline
+	summary['scenarios'] = dict(
+		(name, summarize([sample for sample in samples if sample[1] == name],
+						 elapsed))
+		for name, _weight in mix)
+	return summary
+
+
+def format_line(line):
+	return ("%(time)6.1fs %(throughput)9.1f op/s  p50 %(p50_ms)7.2fms  "
+			"p90 %(p90_ms)7.2fms  p99 %(p99_ms)7.2fms  errors %(errors)d  "
+			"rss %(rss_mb)s  handles %(handles)s") % dict(
+				line,
+				p50_ms = line['p50'] * 1000,
+				p90_ms = line['p90'] * 1000,
+				p99_ms = line['p99'] * 1000,
+				rss_mb = "%.1fMB" % (line['rss'] / 1048576.0)
+				if line['rss'] is not None else '-')
+
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(
+		description = "Drive local RemotingServer with concurrent clients")
+	parser.add_argument('--port', type = int, default = 3000)
+	parser.add_argument('--clients', default = '1,4,16',
+						help = "comma separated client counts, run in turn")
+	parser.add_argument('--duration', type = float, default = 10.0,
+						help = "seconds per client count")
+	parser.add_argument('--mix', type = parse_mix,
+						default = parse_mix('fetch=4,call=4,payload=1,churn=1'),
+						help = "weighted scenarios, e.g. fetch=4,churn=1")
+	parser.add_argument('--interval', type = float, default = 1.0)
+	parser.add_argument('--threads', action = 'store_true',
+						help = "run clients as threads instead of processes")
+	parser.add_argument('--payload-size', type = int, default = 1000)
+	parser.add_argument('--churn-size', type = int, default = 10)
+	parser.add_argument('--tree-depth', type = int, default = 4)
+	parser.add_argument('--fanout', type = int, default = 4)
+	parser.add_argument('--max-in-flight', type = int, default = None)
+	parser.add_argument('--backlog', type = int, default = 128)
+	arguments = parser.parse_args(argv)
+	logging.basicConfig(level = logging.WARNING)
+
+	address = ('localhost', arguments.port)
+	server = ThreadedRemotingServer(address, backlog = arguments.backlog,
+									max_in_flight = arguments.max_in_flight)
+	server.daemon = True
+	export_samples(server, arguments.tree_depth, arguments.fanout)
+	server.start()
+	options = {
+		'payload_size': arguments.payload_size,
+		'churn_size': arguments.churn_size,
+		'tree_depth': arguments.tree_depth,
+		'fanout': arguments.fanout,
+	}
+	summaries = []
+	for clients in [int(count) for count in arguments.clients.split(',')]:
+		print "== %d clients" % clients
+		summary = run_level(server, address, clients, arguments.duration,
+							arguments.mix, options, arguments.interval,
+							not arguments.threads,
+							lambda line: sys.stdout.write(format_line(line) + '\n'))
+		for name, scenario in sorted(summary['scenarios'].iteritems()):
+			print "   %-8s %9.1f op/s  p50 %7.2fms  p99 %7.2fms  errors %d" % (
+				name, scenario['throughput'], scenario['p50'] * 1000,
+				scenario['p99'] * 1000, scenario['errors'])
+		summaries.append(summary)
+	print "== summary"
+	print "clients  throughput      p50      p99   errors      rss  handles"
+	for summary in summaries:
+		print "%7d %9.1f/s %7.2fms %7.2fms %8d %7.1fMB %8d" % (
+			summary['clients'], summary['throughput'], summary['p50'] * 1000,
+			summary['p99'] * 1000, summary['errors'],
+			summary['rss'] / 1048576.0, summary['handles'])
+	server.stop()
+	return summaries
+
+
+if __name__ == '__main__':
+	main()
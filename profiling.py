@@ -0,0 +1,211 @@
+import os
+import sys
+import time
+import base64
+import marshal
+import pstats
+import cProfile
+import threading
+
+from collections import Counter
+
+
+PACKAGE = os.path.dirname(os.path.abspath(__file__))
+STACK = frozenset(['server', 'client', 'command', 'response', 'capsule',
+				   'serializable', 'transport', 'storage', 'cache', 'tracing',
+				   'snapshot', 'profiling'])
+STDLIB = os.path.dirname(os.path.abspath(os.__file__))
+INSTALLED = ('site-packages', 'dist-packages')
+
+
+def internal(filename):
+	# remoting stack itself, standard library (socket, json, uuid used by
+	# the stack) and interpreter builtins; installed packages are not
+	if filename == '~':
+		return True
+	path = os.path.abspath(filename)
+	directory, name = os.path.split(path)
+	if directory == PACKAGE:
+		return os.path.splitext(name)[0] in STACK
+	if not path.startswith(STDLIB + os.sep):
+		return False
+	return not any(part in path.split(os.sep) for part in INSTALLED)
+
+
+def label(filename, line, name):
+	return "%s:%d(%s)" % (filename, line, name)
+
+
+class Profiler(object):
+	# deterministic profile of every processed command, kept per serial
+	mode = 'deterministic'
+
+	def __init__(self, duration):
+		self.deadline = time.time() + duration
+		self._stats = {}
+		# serial -> (pstats.Stats, calls, total time)
+		self._combined = None
+		self._lock = threading.Lock()
+		self._local = threading.local()
+
+	def start(self):
+		pass
+
+	def active(self):
+		return time.time() < self.deadline
+
+	def run(self, function, *args):
+		# function returns its result and serial it is recorded under;
+		# nested runs are part of the enclosing one
+		if getattr(self._local, 'running', False):
+			return function(*args)[0]
+		profile = cProfile.Profile()
+		started = time.time()
+		self._local.running = True
+		profile.enable()
+		try:
+			result, serial = function(*args)
+		finally:
+			profile.disable()
+			self._local.running = False
+		elapsed = time.time() - started
+		if serial is None:
+			return result
+		with self._lock:
+			stats, calls, total = self._stats.get(serial, (None, 0, 0.0))
+			if stats is None:
+				stats = pstats.Stats(profile)
+			else:
+				stats.add(profile)
+			self._stats[serial] = (stats, calls + 1, total + elapsed)
+			# pstats can copy profiles, not other stats
+			if self._combined is None:
+				self._combined = pstats.Stats(profile)
+			else:
+				self._combined.add(profile)
+		return result
+
+	def stop(self):
+		self.deadline = 0
+
+	def report(self, top = 20):
+		with self._lock:
+			collected = dict(self._stats)
+			combined = self._combined
+		by_serial = {}
+		for serial, (stats, calls, total) in collected.iteritems():
+			by_serial[serial] = {
+				'calls': calls,
+				'time': total,
+				'pstats': self.encode(stats),
+			}
+		functions = []
+		if combined is not None:
+			for (filename, line, name), entry in combined.stats.iteritems():
+				if not internal(filename):
+					_primitive, calls, own, cumulative, _callers = entry
+					functions.append({
+						'function': label(filename, line, name),
+						'calls': calls,
+						'time': own,
+						'cumulative': cumulative,
+					})
+		functions.sort(key = lambda function: -function['cumulative'])
+		return {
+			'mode': self.mode,
+			'by_serial': by_serial,
+			'callables': functions[:top],
+			'pstats': self.encode(combined) if combined is not None else None,
+		}
+
+	@classmethod
+	def encode(cls, stats):
+		# same content as pstats.Stats.dump_stats writes
+		return base64.b64encode(marshal.dumps(stats.stats))
+
+
+class Sampler(object):
+	# samples stacks of threads processing commands, nothing is hooked into
+	# processing itself
+	mode = 'sampling'
+
+	def __init__(self, duration, interval = 0.005, code = None):
+		self.deadline = time.time() + duration
+		self._interval = interval
+		self._code = code
+		# code object of the frame handling received frame
+		self._stacks = Counter()
+		self._samples = 0
+		self._thread = threading.Thread(target = self.sample,
+										name = 'RemotingSampler')
+		self._thread.daemon = True
+
+	def start(self):
+		self._thread.start()
+
+	def active(self):
+		return False
+
+	def sample(self):
+		own = threading.current_thread().ident
+		while time.time() < self.deadline:
+			for ident, frame in sys._current_frames().items():
+				if ident != own:
+					self.record(frame)
+			self._samples += 1
+			time.sleep(self._interval)
+
+	def record(self, frame):
+		stack = []
+		serial = None
+		while frame is not None:
+			code = frame.f_code
+			if code is self._code:
+				data = frame.f_locals.get('data') or {}
+				# 'frame' until received frame is decoded
+				serial = data.get('serial') or data.get('control') or 'frame'
+				break
+			stack.append(label(code.co_filename, code.co_firstlineno,
+							   code.co_name))
+			frame = frame.f_back
+		if serial is not None:
+			# idle threads are not processing anything
+			stack.append(serial)
+			self._stacks[tuple(reversed(stack))] += 1
+
+	def stop(self):
+		self.deadline = 0
+		if self._thread.is_alive():
+			self._thread.join()
+
+	def report(self, top = 20):
+		stacks = dict(self._stacks)
+		by_serial = Counter()
+		functions = Counter()
+		for stack, count in stacks.iteritems():
+			by_serial[stack[0]] += count
+			for function in set(stack[1:]):
+				if not internal(function.rsplit(':', 1)[0]):
+					functions[function] += count
+		return {
+			'mode': self.mode,
+			'samples': self._samples,
+			'interval': self._interval,
+			'by_serial': dict(by_serial),
+			'callables': [{'function': function, 'samples': count}
+						  for function, count in functions.most_common(top)],
+			'folded': ''.join('%s %d\n' % (';'.join(stack), count)
+							  for stack, count in sorted(stacks.iteritems())),
+		}
+
+
+def save(report, path, serial = None):
+	# pstats file for deterministic profile, folded stacks for sampling one;
+	# both load in common viewers (snakeviz, speedscope, flamegraph.pl)
+	with open(path, 'wb') as output:
+		if report['mode'] == Sampler.mode:
+			output.write(report['folded'])
+		else:
+			encoded = report['pstats'] if serial is None \
+				else report['by_serial'][serial]['pstats']
+			output.write(base64.b64decode(encoded))
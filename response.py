@@ -11,23 +11,82 @@ class Response(Serializable):
 	def interpret(self, proxy):
 		raise NotImplementedError(self)
 
+	def discard(self, actual):
+		pass
+
+	def actual_value(self, actual):
+		# result of callback, as seen by server
+		raise NotImplementedError(self)
+
+
+def handle_ids(data, found = None):
+	# ids of handles anywhere in serialized response or command
+	if found is None:
+		found = []
+	if isinstance(data, dict):
+		if 'id' in data and (data.get('serial') == 'handle'
+							 or data.get('kind') == 'handle'):
+			found.append(data['id'])
+		for value in data.itervalues():
+			handle_ids(value, found)
+	elif isinstance(data, list):
+		for value in data:
+			handle_ids(value, found)
+	return found
+
+
+def type_name(obj):
+	cls = getattr(obj, '__class__', type(obj))
+	return cls.__module__ + '.' + cls.__name__
+
 
 class HandleResponse(Response):
 	serial = 'handle'
 
-	def __init__(self, id):
+	def __init__(self, id, type = None, cacheable = False):
 		Response.__init__(self)
 		self._id = id
+		self._type = type
+		self._cacheable = cacheable
 
 	@classmethod
 	def build(cls, data):
-		return cls(uuid.UUID(hex = data['id']))
+		return cls(uuid.UUID(hex = data['id']), data.get('type'),
+				   data.get('cacheable', False))
 
 	def data(self):
-		return {'id': self._id.hex}
+		data = {'id': self._id.hex, 'type': self._type}
+		if self._cacheable:
+			data['cacheable'] = True
+		return data
 
 	def interpret(self, proxy):
-		return proxy.handle(self._id)
+		return proxy.handle(self._id, self._type, self._cacheable)
+
+	def discard(self, actual):
+		actual.release(self._id)
+
+
+class DescriptionResponse(Response):
+	serial = 'description'
+
+	def __init__(self, type, methods):
+		Response.__init__(self)
+		self._type = type
+		self._methods = methods
+
+	@classmethod
+	def build(cls, data):
+		return cls(data['type'], data['methods'])
+
+	def data(self):
+		return {
+			'type': self._type,
+			'methods': list(self._methods),
+		}
+
+	def interpret(self, _proxy):
+		return frozenset(self._methods)
 
 
 class EvaluationResponse(Response):
@@ -53,6 +112,60 @@ class EvaluationResponse(Response):
 	def interpret(self, proxy):
 		return self._value.proxy_value(proxy)
 
+	def actual_value(self, actual):
+		return self._value.actual_value(actual)
+
+	def discard(self, actual):
+		# unserializable parts of value were stored as handles
+		for id in handle_ids(self._value.serialized()):
+			actual.release(uuid.UUID(hex = id))
+
+
+class SnapshotResponse(Response):
+	serial = 'snapshot'
+
+	def __init__(self, root, nodes):
+		Response.__init__(self)
+		self._root = root
+		self._nodes = nodes
+
+	@classmethod
+	def build(cls, data):
+		return cls(data['root'], data['nodes'])
+
+	def data(self):
+		return {
+			'root': self._root,
+			'nodes': self._nodes,
+		}
+
+	def interpret(self, proxy):
+		from remoteable.snapshot import SnapshotReader
+		return SnapshotReader(proxy, self._nodes).value(self._root)
+
+	def discard(self, actual):
+		for node in self._nodes:
+			if node['kind'] == 'handle':
+				actual.release(uuid.UUID(hex = node['id']))
+
+
+class ProfileResponse(Response):
+	serial = 'profile'
+
+	def __init__(self, report):
+		Response.__init__(self)
+		self._report = report
+
+	@classmethod
+	def build(cls, data):
+		return cls(data['report'])
+
+	def data(self):
+		return {'report': self._report}
+
+	def interpret(self, _proxy):
+		return self._report
+
 
 class EmptyResponse(Response):
 	serial = 'empty'
@@ -69,6 +182,9 @@ class EmptyResponse(Response):
 	def interpret(self, _proxy):
 		return None
 
+	def actual_value(self, _actual):
+		return None
+
 
 class ErrorResponse(Response):
 	serial = 'error'
@@ -94,6 +210,9 @@ class ErrorResponse(Response):
 	def interpret(self, _proxy):
 		raise self._exception
 
+	def actual_value(self, _actual):
+		raise self._exception
+
 
 class OperationErrorResponse(ErrorResponse):
 	serial = 'error-operation'
@@ -111,11 +230,48 @@ class ExecutionErrorResponse(ErrorResponse):
 	serial = 'error-execution'
 
 
+class ResourceErrorResponse(ErrorResponse):
+	serial = 'error-resource'
+
+
+class DeadlineExceededError(Exception):
+	pass
+
+
+class DeadlineResponse(ErrorResponse):
+	serial = 'error-deadline'
+
+
+class ServerBusyError(Exception):
+	pass
+
+
+class BusyResponse(ErrorResponse):
+	serial = 'busy'
+
+	def __init__(self, exception, reconnect = False):
+		ErrorResponse.__init__(self, exception)
+		self._reconnect = reconnect
+
+	@classmethod
+	def build(cls, data):
+		return cls(ServerBusyError(data['text']), data['reconnect'])
+
+	def data(self):
+		return dict(ErrorResponse.data(self), reconnect = self._reconnect)
+
+
 HandleResponse.register()
+DescriptionResponse.register()
 EvaluationResponse.register()
+SnapshotResponse.register()
+ProfileResponse.register()
 EmptyResponse.register()
 ErrorResponse.register()
 OperationErrorResponse.register()
 AccessErrorResponse.register()
 AttributeErrorResponse.register()
 ExecutionErrorResponse.register()
+ResourceErrorResponse.register()
+BusyResponse.register()
+DeadlineResponse.register()
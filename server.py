@@ -1,83 +1,642 @@
 
 import json
-import logging
+import time
 import uuid
+import socket
+import logging
+import heapq
+import itertools
 
+from threading import Lock, local
+from weakref import WeakValueDictionary
+from collections import deque
+
+from remoteable.capsule import Capsule, HandleCapsule, TupleCapsule, DictionaryCapsule
 from remoteable.command import Command
+from remoteable.response import Response, ExecutionErrorResponse
+from remoteable.response import ResourceErrorResponse, BusyResponse, ServerBusyError
+from remoteable.response import DeadlineResponse, DeadlineExceededError
+from remoteable.storage import ReferenceTable, SpillStore, MemoryBudgetError
+from remoteable.cache import ResultCache
+from remoteable.tracing import Span, NULL_SPAN
+from remoteable.profiling import Profiler, Sampler
+from remoteable.transport import Channel, Compressor, ConnectionClosed
+
+
+def cacheable(function):
+	function.remoteable_cacheable = True
+	return function
+
+
+_executing = local()
+# expiry of command executed by current thread, callbacks wait until then
 
 
 class RemotingActual(object):
-	def __init__(self, name):
+	def __init__(self, name, memory_budget = None, spill = False,
+				 spill_directory = None, cache_size = 1024, cache_ttl = None,
+				 recorder = None):
 		self._logger = logging.getLogger("actual.%s" % name)
+		self.recorder = recorder
 		self._exports = {}
-		self._references = {}
+		self._cacheable = {}
+		self._references = ReferenceTable(memory_budget,
+										  SpillStore(spill_directory)
+										  if spill else None)
+		self.results = ResultCache(cache_size, cache_ttl)
+		self._watchers = {}
+		# id of watched object -> (object, {session: handle ids})
+		self._watched = {}
+		# watched handle id -> id of its object
+		self.profiler = None
+		self._sampler = None
+		self._lock = Lock()
 
-	def process(self, data):
+	def process(self, data, received = None, session = None, admitted = None):
 		self._logger.debug("received: %s", data)
+		span = Span.resume(data['trace'], received) if 'trace' in data else NULL_SPAN
+		if admitted is not None:
+			span.mark('queue', admitted)
+		span.mark('decode')
 		command = Command.construct(data)
-		response = command.execute(self)
+		span.mark('construct')
+		expires = None
+		if 'deadline' in data:
+			expires = (received or time.time()) + data['deadline']
+		if expires is not None and time.time() > expires:
+			response = DeadlineResponse(DeadlineExceededError(
+				"Deadline expired before execution"))
+		else:
+			previous, _executing.expires = \
+				getattr(_executing, 'expires', None), expires
+			try:
+				response = self.execute(command, session)
+			finally:
+				_executing.expires = previous
+			if expires is not None and time.time() > expires:
+				# client has given up already, nobody will read the result
+				response.discard(self)
+				response = DeadlineResponse(DeadlineExceededError(
+					"Deadline expired during execution"))
+		span.mark('execute')
 		serialized = response.serialized()
+		span.mark('serialize')
+		if span is not NULL_SPAN:
+			serialized['trace'] = span.report()
+		if self.recorder is not None:
+			self.recorder.record(received or time.time(),
+								 session.id if session is not None else None,
+								 data, serialized)
 		self._logger.debug("response: %s", serialized)
 		return serialized
 
-	def export(self, obj, remote_name):
+	def execute(self, command, session = None):
+		try:
+			return command.execute(session if session is not None else self)
+		except MemoryBudgetError, ex:
+			self._logger.warning("Rejected %s: %s", command.serial, ex)
+			return ResourceErrorResponse(ex)
+
+	def export(self, obj, remote_name, cacheable = False):
 		self._exports[remote_name] = obj
+		if cacheable:
+			self._cacheable[id(obj)] = obj
 
-	def fetch(self, name):
+	def is_cacheable(self, obj):
+		if id(obj) in self._cacheable:
+			return True
+		owner = getattr(obj, '__self__', None)
+		if owner is not None and id(owner) in self._cacheable:
+			return True
+		target = getattr(obj, '__func__', obj)
+		return getattr(target, 'remoteable_cacheable', False)
+
+	def cache_key(self, function, args, kwargs):
+		if not self.is_cacheable(function):
+			return None
+		canonical = json.dumps([args.serialized(), kwargs.serialized()],
+							   sort_keys = True)
+		owner = getattr(function, '__self__', None)
+		target = getattr(function, '__func__', function)
+		return (id(owner), id(target), canonical)
+
+	def watch(self, obj, handle, session = None):
+		if session is None:
+			return
+		with self._lock:
+			_obj, watched = self._watchers.setdefault(id(obj), (obj, {}))
+			watched.setdefault(session, set()).add(handle)
+			self._watched[handle] = id(obj)
+
+	def unwatch(self, handle):
+		with self._lock:
+			key = self._watched.pop(handle, None)
+			if key is None:
+				return
+			_obj, watched = self._watchers[key]
+			for session, handles in watched.items():
+				handles.discard(handle)
+				if not handles:
+					del watched[session]
+			if not watched:
+				del self._watchers[key]
+
+	def modified(self, obj):
+		self.results.invalidate(obj)
+		with self._lock:
+			_obj, watched = self._watchers.pop(id(obj), (None, {}))
+			for handles in watched.itervalues():
+				for handle in handles:
+					self._watched.pop(handle, None)
+		for session, handles in watched.iteritems():
+			session.invalidated(handles)
+
+	def invalidate(self, obj = None):
+		if obj is not None:
+			return self.modified(obj)
+		self.results.invalidate()
+		with self._lock:
+			watchers, self._watchers = self._watchers, {}
+			self._watched.clear()
+		for _obj, watched in watchers.itervalues():
+			for session, handles in watched.iteritems():
+				session.invalidated(handles)
+
+	def wrap(self, value):
+		# values which cannot be sent are passed as handles
+		try:
+			capsule = Capsule.wrap(value)
+			capsule.serialized()
+		except TypeError:
+			capsule = HandleCapsule(self.store(value))
+		return capsule
+
+	def connected(self):
+		return False
+
+	def callback(self, _id):
+		raise TypeError("Callbacks require client connection")
+
+	def disconnected(self, session):
+		with self._lock:
+			for _obj, watched in self._watchers.itervalues():
+				for handle in watched.pop(session, ()):
+					self._watched.pop(handle, None)
+
+	def fetch(self, name, owner = None):
 		if name not in self._exports:
 			raise KeyError(name)
-		return self.store(self._exports[name])
+		return self._references.store(self._exports[name], pinned = True,
+									  owner = owner)
 
-	def store(self, value):
-		id = uuid.uuid4()
-		self._references[id] = value
-		return id
+	def store(self, value, owner = None):
+		return self._references.store(value, owner = owner)
 
 	def access(self, id):
-		return self._references[id]
+		return self._references.access(id)
 
 	def release(self, id):
-		del self._references[id]
+		self._references.release(id)
+		self.unwatch(id)
+
+	def stats(self):
+		return {
+			'handles': len(self._references),
+			'memory': self._references.usage(),
+			'results': self.results.stats(),
+		}
+
+	def introspect(self, top = 10, sample = 1000):
+		return self._references.introspect(top, sample)
+
+	def profile(self, duration, mode = Profiler.mode, interval = 0.005):
+		self.profile_report()
+		if mode == Profiler.mode:
+			self.profiler = Profiler(duration)
+		elif mode == Sampler.mode:
+			self._sampler = Sampler(duration, interval,
+									RemoteHandler.handle.__func__.__code__)
+			self._sampler.start()
+		else:
+			raise ValueError("Unknown profiling mode %r" % (mode,))
+
+	def profile_report(self, top = 20):
+		# stops profiling, returns None when it was not running
+		profiler = self.profiler or self._sampler
+		self.profiler = self._sampler = None
+		if profiler is None:
+			return None
+		profiler.stop()
+		return profiler.report(top)
+
+
+class RemoteCallback(object):
+	# client callable, called back over connection it was received by
+	def __init__(self, session, id):
+		self._session = session
+		self._id = id
+
+	def __call__(self, *args, **kwargs):
+		return self._session.call_back(self._id, args, kwargs)
+
+	def notify(self, *args, **kwargs):
+		self._session.call_back(self._id, args, kwargs, reply = False)
+
+	def connected(self):
+		return self._session.connected()
+
+	def __del__(self):
+		self._session.release_callback(self._id)
+
+	def __repr__(self):
+		return "<RemoteCallback (%s) of %r>" % (self._id, self._session)
+
+
+class Topic(object):
+	def __init__(self):
+		self._subscribers = []
+		self._lock = Lock()
+
+	def subscribe(self, callback):
+		with self._lock:
+			if callback not in self._subscribers:
+				self._subscribers.append(callback)
+
+	def unsubscribe(self, callback):
+		with self._lock:
+			if callback in self._subscribers:
+				self._subscribers.remove(callback)
+
+	def publish(self, *args, **kwargs):
+		with self._lock:
+			subscribers = list(self._subscribers)
+		for callback in subscribers:
+			if callback.connected():
+				callback.notify(*args, **kwargs)
+			else:
+				self.unsubscribe(callback)
+
+	def __len__(self):
+		return len(self._subscribers)
+
+
+class RemotingSession(object):
+	# actual as seen by commands of single connection
+	_ids = itertools.count(1)
+
+	def __init__(self, actual, handler):
+		self.id = next(self._ids)
+		self.priority = None
+		self._actual = actual
+		self._handler = handler
+		self._callbacks = WeakValueDictionary()
+		# single callback object per client callable, so they compare equal
+
+	def fetch(self, name):
+		return self._actual.fetch(name, self.id)
+
+	def store(self, value):
+		return self._actual.store(value, self.id)
 
+	def watch(self, obj, handle):
+		self._actual.watch(obj, handle, self)
+
+	def invalidated(self, handles):
+		self._handler.push({
+			'control': 'invalidate',
+			'handles': [handle.hex for handle in handles],
+		})
+
+	def connected(self):
+		return self._handler.connected
+
+	def callback(self, id):
+		callback = self._callbacks.get(id)
+		if callback is None:
+			callback = RemoteCallback(self, id)
+			self._callbacks[id] = callback
+		return callback
+
+	def call_back(self, callback, args, kwargs, reply = True):
+		args = TupleCapsule(tuple(self.wrap(arg) for arg in args))
+		kwargs = DictionaryCapsule(dict((key, self.wrap(value))
+										for key, value in kwargs.iteritems()))
+		response = self._handler.call_back(callback, args, kwargs, reply)
+		if reply:
+			return response.actual_value(self)
+
+	def release_callback(self, callback):
+		if self._handler.connected:
+			self._handler.push({
+				'control': 'callback-release',
+				'callback': callback.hex,
+			})
+
+	def __getattr__(self, name):
+		return getattr(self._actual, name)
+
+	def __repr__(self):
+		return "<%s of %r>" % (self.__class__.__name__, self._handler)
+
+
+from threading import Thread, Condition, Event, current_thread
+
+class PendingCall(object):
+	def __init__(self):
+		self._event = Event()
+		self._response = None
+
+	def complete(self, response):
+		self._response = Response.construct(response)
+		self._event.set()
+
+	def cancel(self):
+		self._response = ExecutionErrorResponse(
+			ConnectionClosed("Connection closed before callback returned"))
+		self._event.set()
+
+	def done(self):
+		return self._event.is_set()
+
+	def wait(self, timeout = None):
+		if not self._event.wait(timeout):
+			return DeadlineResponse(DeadlineExceededError(
+				"Deadline expired waiting for callback"))
+		return self._response
+
+
+class Admission(object):
+	# commands waiting for free slot are started in weighted fair order:
+	# each connection advances its own virtual time by execution time
+	# divided by weight of its priority class, lowest start tag goes first
+	priorities = {'interactive': 4, 'normal': 2, 'batch': 1}
+	default = 'normal'
+	poll_interval = 0.01
+
+	def __init__(self, max_in_flight = None, max_queued = None,
+				 priorities = None):
+		self._max_in_flight = max_in_flight
+		self._max_queued = max_queued
+		if priorities is not None:
+			self.priorities = priorities
+		self._in_flight = 0
+		self._waiting = []
+		# heap of (start tag, sequence number)
+		self._sequence = itertools.count()
+		self._virtual = 0.0
+		self._finish = {}
+		# session -> virtual time its last command finished at
+		self._started = {}
+		# session -> start tag of its running command
+		self._condition = Condition()
+
+	def weight(self, session):
+		priority = getattr(session, 'priority', None)
+		return self.priorities.get(priority, self.priorities[self.default])
+
+	def acquire(self, session = None, poll = None):
+		# poll is called regularly while command waits, so that its
+		# connection is still served
+		with self._condition:
+			if self._max_in_flight is None:
+				self._in_flight += 1
+				return True
+			tag = max(self._virtual, self._finish.get(session, 0.0))
+			if self._in_flight >= self._max_in_flight or self._waiting:
+				if self._max_queued is not None \
+						and len(self._waiting) >= self._max_queued:
+					return False
+				entry = (tag, next(self._sequence))
+				heapq.heappush(self._waiting, entry)
+				try:
+					while self._in_flight >= self._max_in_flight \
+							or self._waiting[0] != entry:
+						if poll is None:
+							self._condition.wait()
+							continue
+						self._condition.wait(self.poll_interval)
+						self._condition.release()
+						try:
+							poll()
+						finally:
+							self._condition.acquire()
+				except Exception:
+					self._waiting.remove(entry)
+					heapq.heapify(self._waiting)
+					self._condition.notify_all()
+					raise
+				heapq.heappop(self._waiting)
+			self._in_flight += 1
+			self._virtual = max(self._virtual, tag)
+			self._started[session] = tag
+			self._condition.notify_all()
+			return True
+
+	def release(self, session = None, cost = 0.0):
+		with self._condition:
+			self._in_flight -= 1
+			if session in self._started:
+				self._finish[session] = self._started.pop(session) \
+					+ cost / self.weight(session)
+			self._condition.notify_all()
+
+	def forget(self, session):
+		with self._condition:
+			self._finish.pop(session, None)
+
+	def load(self):
+		return self._in_flight, len(self._waiting)
 
-from threading import Thread
 
 class RemoteHandler(Thread):
 	def __init__(self, server, client_socket, client_address):
 		Thread.__init__(self)
 		self._logger = logging.getLogger("remoting.handler.%s:%s" % client_address)
 		self._server = server
-		self._socket = client_socket
+		self._channel = Channel(client_socket, threshold = server.threshold)
+		self._session = RemotingSession(server, self)
+		self._pending = {}
+		self._backlog = deque()
+		# commands pipelined while earlier one waited for admission
+		self.connected = True
 		self._logger.info("Starting")
 
 	def run(self):
 		try:
-			while True:
-				try:
-					data = json.loads(self._socket.recv(65535))
-				except ValueError:
-					self._logger.info("Stopping: Invalid JSON received")
-					break
-				result = self._server.process(data)
-				self._socket.send(json.dumps(result))
+			self.serve()
+		finally:
+			self.connected = False
+			for pending in self._pending.values():
+				pending.cancel()
+			self._server.disconnected(self._session)
+
+	def serve(self):
+		try:
+			while self.step():
+				pass
 		except Exception:
 			self._logger.info("Stopping: Unhandled exception", exc_info = True)
 			self.stop()
 			raise
 
-	def stop(self):
-		self._socket.close()
+	def step(self, nested = False):
+		# commands received while waiting for callback result are nested
+		# in command already admitted, even when other thread waits for it
+		nested = nested or bool(self._pending)
+		payload = length = None
+		if self._backlog and not nested:
+			flags, payload = self._backlog.popleft()
+		else:
+			try:
+				flags, length = self._channel.receive_header()
+			except ConnectionClosed:
+				self._logger.info("Stopping: Connection closed")
+				return False
+		profiler = self._server.profiler
+		if profiler is not None and profiler.active():
+			return profiler.run(self.handle, flags, length, nested, payload)
+		return self.handle(flags, length, nested, payload)[0]
+
+	def handle(self, flags, length, nested, payload = None):
+		# whole frame after its header arrived, returns whether to continue
+		# and kind of frame handled
+		if payload is None:
+			try:
+				payload = self._channel.receive_payload(length)
+			except ConnectionClosed:
+				self._logger.info("Stopping: Connection closed")
+				return False, None
+		received = time.time()
+		if flags & Channel.CONTROL:
+			data = self.unpack(flags, payload)
+			if data is None:
+				return False, None
+			self.control(data)
+			return True, data.get('control')
+		try:
+			if not nested and not self._server.admission.acquire(
+					self._session, self.serve_waiting):
+				self.reject("Too many commands in flight")
+				return True, BusyResponse.serial
+		except ConnectionClosed:
+			self._logger.info("Stopping: Connection closed while waiting")
+			return False, None
+		admitted = time.time()
+		try:
+			data = self.unpack(flags, payload)
+			if data is None:
+				return False, None
+			result = self._server.process(data, received, self._session,
+										  admitted)
+		finally:
+			if not nested:
+				self._server.admission.release(self._session,
+											   time.time() - admitted)
+		self._channel.send(result)
+		return True, data.get('serial')
 
+	def serve_waiting(self):
+		# client of waiting command may still answer callbacks of others;
+		# its other commands keep their order and wait for admission
+		while self._channel.readable():
+			flags, length = self._channel.receive_header()
+			if flags & Channel.CONTROL or self._pending:
+				if not self.handle(flags, length, True)[0]:
+					raise ConnectionClosed()
+			else:
+				self._backlog.append((flags,
+									  self._channel.receive_payload(length)))
+
+	def unpack(self, flags, payload):
+		try:
+			return self._channel.unpack(flags, payload)
+		except ValueError:
+			self._logger.info("Stopping: Invalid JSON received")
+			return None
+
+	def control(self, data):
+		kind = data.get('control')
+		if kind == 'negotiate':
+			compressor = Compressor.negotiate(data.get('compression', []),
+											  self._server.compressors)
+			if data.get('priority') in self._server.admission.priorities:
+				self._session.priority = data['priority']
+			self._channel.send({
+				'control': 'negotiate',
+				'compression': compressor.name if compressor else None,
+				'priority': self._session.priority,
+			}, control = True)
+			self._channel.compressor = compressor
+		elif kind == 'callback-result':
+			pending = self._pending.pop(uuid.UUID(hex = data['call']), None)
+			if pending is not None:
+				pending.complete(data['response'])
+		else:
+			self._logger.info("Unknown control message: %s", data)
+
+	def call_back(self, callback, args, kwargs, reply = True):
+		call = uuid.uuid4()
+		message = {
+			'control': 'callback',
+			'call': call.hex,
+			'callback': callback.hex,
+			'args': args.serialized(),
+			'kwargs': kwargs.serialized(),
+			'reply': reply,
+		}
+		if not reply:
+			self.push(message)
+			return None
+		expires = getattr(_executing, 'expires', None)
+
+		def remaining():
+			return None if expires is None else max(expires - time.time(), 0)
+
+		pending = PendingCall()
+		self._pending[call] = pending
+		try:
+			self._channel.send(message, control = True)
+			if current_thread() is self:
+				# this thread reads connection, so it has to wait for result
+				# by serving messages
+				while not pending.done():
+					if expires is not None \
+							and not self._channel.readable(remaining()):
+						break
+					if not self.step(nested = True):
+						pending.cancel()
+			return pending.wait(remaining())
+		finally:
+			self._pending.pop(call, None)
+
+	def push(self, data):
+		try:
+			self._channel.send(data, control = True)
+		except socket.error:
+			self.connected = False
+			self._logger.info("Failed to push %s", data, exc_info = True)
+
+	def reject(self, reason):
+		response = BusyResponse(ServerBusyError(reason))
+		self._channel.send(response.serialized())
+
+	def stop(self):
+		self._channel.close()
 
-import socket
 
 class RemotingServer(RemotingActual):
-	def __init__(self, server_address):
-		RemotingActual.__init__(self, "%s.%s" % server_address)
+	def __init__(self, server_address, compressors = None, threshold = 1024,
+				 max_connections = None, max_in_flight = None,
+				 max_queued = None, priorities = None, backlog = 5, **kwargs):
+		RemotingActual.__init__(self, "%s.%s" % server_address, **kwargs)
+		self.compressors = compressors
+		self.threshold = threshold
+		self.admission = Admission(max_in_flight, max_queued, priorities)
+		self._max_connections = max_connections
 		self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		self._socket.bind(server_address)
-		self._socket.listen(1)
+		self._socket.listen(backlog)
 		self._handlers = []
 
 	def run(self):
@@ -85,6 +644,12 @@ class RemotingServer(RemotingActual):
 		try:
 			while True:
 				connected_socket, connected_address = self._socket.accept()
+				self._handlers = [handler for handler in self._handlers
+								  if handler.isAlive()]
+				if self._max_connections is not None \
+						and len(self._handlers) >= self._max_connections:
+					self.refuse(connected_socket, connected_address)
+					continue
 				handler = RemoteHandler(self, connected_socket,
 										connected_address)
 				handler.start()
@@ -94,6 +659,23 @@ class RemotingServer(RemotingActual):
 			self.stop()
 			raise
 
+	def refuse(self, connected_socket, connected_address):
+		# no handler thread is started for connections over the limit
+		self._logger.info("Refusing %s:%s: Too many connections",
+						  *connected_address)
+		channel = Channel(connected_socket)
+		response = BusyResponse(ServerBusyError("Too many connections"),
+								reconnect = True)
+		try:
+			channel.send(response.serialized())
+		except socket.error:
+			pass
+		channel.close()
+
+	def disconnected(self, session):
+		RemotingActual.disconnected(self, session)
+		self.admission.forget(session)
+
 	def stop(self):
 		for handler in self._handlers:
 			handler.stop()		
@@ -101,6 +683,6 @@ class RemotingServer(RemotingActual):
 
 
 class ThreadedRemotingServer(RemotingServer, Thread):
-	def __init__(self, server_address):
+	def __init__(self, server_address, **kwargs):
 		Thread.__init__(self, name = 'RemotingServer.%s:%s' % server_address)
-		RemotingServer.__init__(self, server_address)
+		RemotingServer.__init__(self, server_address, **kwargs)
@@ -0,0 +1,159 @@
+import uuid
+import types
+
+from remoteable.capsule import Capsule
+from remoteable.response import type_name
+
+
+class SnapshotWriter(object):
+	# flattens object graph into node table, shared and cyclic references
+	# point to earlier nodes
+	containers = {
+		list: 'list',
+		tuple: 'tuple',
+		set: 'set',
+		frozenset: 'frozenset',
+		dict: 'dict',
+	}
+
+	opaque = (type, types.ClassType, types.FunctionType, types.MethodType,
+			  types.BuiltinFunctionType, types.ModuleType)
+
+	def __init__(self, actual, exclude = ()):
+		self._actual = actual
+		self._exclude = frozenset(exclude)
+		self._nodes = []
+		self._indices = {}
+		# id of object -> node index
+
+	def write(self, obj, depth):
+		root = self.value(obj, depth)
+		return root, self._nodes
+
+	def value(self, obj, depth):
+		expandable = self.expandable(obj)
+		if not expandable:
+			try:
+				return Capsule.wrap(obj).serialized()
+			except TypeError:
+				pass
+		if id(obj) in self._indices:
+			return {'ref': self._indices[id(obj)]}
+		index = len(self._nodes)
+		self._indices[id(obj)] = index
+		self._nodes.append(None)
+		if depth <= 0 or not expandable:
+			self._nodes[index] = self.handle(obj)
+		else:
+			self._nodes[index] = self.node(obj, depth - 1)
+		return {'ref': index}
+
+	def expandable(self, obj):
+		if type(obj) in self.containers:
+			return True
+		if isinstance(obj, self.opaque):
+			return False
+		return hasattr(obj, '__dict__') or bool(self.slots(type(obj)))
+
+	def handle(self, obj):
+		return {
+			'kind': 'handle',
+			'id': self._actual.store(obj).hex,
+			'type': type_name(obj),
+		}
+
+	def node(self, obj, depth):
+		kind = self.containers.get(type(obj))
+		if kind == 'dict':
+			return {
+				'kind': kind,
+				'items': [[self.value(key, depth), self.value(value, depth)]
+						  for key, value in obj.iteritems()],
+			}
+		if kind is not None:
+			return {
+				'kind': kind,
+				'items': [self.value(item, depth) for item in obj],
+			}
+		attributes = {}
+		for name in self.slots(type(obj)):
+			if name not in self._exclude and hasattr(obj, name):
+				attributes[name] = self.value(getattr(obj, name), depth)
+		for name, value in getattr(obj, '__dict__', {}).iteritems():
+			if name not in self._exclude:
+				attributes[name] = self.value(value, depth)
+		return {
+			'kind': 'object',
+			'type': type_name(obj),
+			'attributes': attributes,
+		}
+
+	@classmethod
+	def slots(cls, object_class):
+		names = []
+		for klass in getattr(object_class, '__mro__', ()):
+			slots = klass.__dict__.get('__slots__', ())
+			if isinstance(slots, basestring):
+				slots = (slots,)
+			for name in slots:
+				if name in ('__dict__', '__weakref__'):
+					continue
+				if name.startswith('__') and not name.endswith('__'):
+					name = '_%s%s' % (klass.__name__.lstrip('_'), name)
+				names.append(name)
+		return names
+
+
+class RemoteSnapshot(object):
+	# detached copy of remote object state at the time of snapshot
+	__slots__ = ('__dict__', '_snapshot_type')
+
+	def __init__(self, type):
+		self._snapshot_type = type
+
+	def __repr__(self):
+		return "<RemoteSnapshot of %s>" % (self._snapshot_type,)
+
+
+class SnapshotReader(object):
+	def __init__(self, proxy, nodes):
+		self._proxy = proxy
+		self._nodes = nodes
+		self._built = {}
+
+	def value(self, data):
+		if 'ref' in data:
+			return self.node(data['ref'])
+		return Capsule.construct(data).proxy_value(self._proxy)
+
+	def node(self, index):
+		if index in self._built:
+			return self._built[index]
+		node = self._nodes[index]
+		kind = node['kind']
+		# mutable values are remembered before their content is built, so
+		# cycles resolve to them
+		if kind == 'handle':
+			built = self._proxy.handle(uuid.UUID(hex = node['id']), node['type'])
+			self._built[index] = built
+		elif kind == 'object':
+			built = RemoteSnapshot(node['type'])
+			self._built[index] = built
+			for name, value in node['attributes'].iteritems():
+				setattr(built, name, self.value(value))
+		elif kind == 'dict':
+			built = {}
+			self._built[index] = built
+			for key, value in node['items']:
+				built[self.value(key)] = self.value(value)
+		elif kind in ('list', 'set'):
+			built = list() if kind == 'list' else set()
+			self._built[index] = built
+			add = built.append if kind == 'list' else built.add
+			for item in node['items']:
+				add(self.value(item))
+		else:
+			handled = tuple if kind == 'tuple' else frozenset
+			built = handled(self.value(item) for item in node['items'])
+			self._built[index] = built
+		return built
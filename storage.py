@@ -0,0 +1,297 @@
+import sys
+import time
+import uuid
+import heapq
+import random
+import operator
+import cPickle
+import tempfile
+import itertools
+import threading
+
+from types import NoneType
+from collections import OrderedDict
+
+
+class MemoryBudgetError(MemoryError):
+	pass
+
+
+class SpillStore(object):
+	def __init__(self, directory = None):
+		self._directory = directory
+		self._file = tempfile.TemporaryFile(prefix = 'remoteable-spill-',
+											dir = directory)
+		self._index = {}
+		self._end = 0
+		self._dead = 0
+
+	def put(self, id, value):
+		payload = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+		self._file.seek(self._end)
+		self._file.write(payload)
+		self._index[id] = (self._end, len(payload))
+		self._end += len(payload)
+
+	def take(self, id):
+		offset, length = self._index.pop(id)
+		self._file.seek(offset)
+		value = cPickle.loads(self._file.read(length))
+		self._discarded(length)
+		return value
+
+	def discard(self, id):
+		_offset, length = self._index.pop(id)
+		self._discarded(length)
+
+	def _discarded(self, length):
+		self._dead += length
+		if self._dead * 2 > self._end:
+			self.compact()
+
+	def compact(self):
+		compacted = tempfile.TemporaryFile(prefix = 'remoteable-spill-',
+										   dir = self._directory)
+		index = {}
+		end = 0
+		for id, (offset, length) in self._index.iteritems():
+			self._file.seek(offset)
+			compacted.write(self._file.read(length))
+			index[id] = (end, length)
+			end += length
+		self._file.close()
+		self._file = compacted
+		self._index = index
+		self._end = end
+		self._dead = 0
+
+	def size(self):
+		return self._end - self._dead
+
+	def __contains__(self, id):
+		return id in self._index
+
+	def __len__(self):
+		return len(self._index)
+
+	def close(self):
+		self._file.close()
+
+
+class ReferenceTable(object):
+	atoms = (int, long, float, complex, bool, str, unicode, NoneType)
+	containers = (list, tuple, dict, set, frozenset)
+
+	sample = 64
+	# containers longer than that have their size extrapolated
+
+	def __init__(self, budget = None, spill = None):
+		self._budget = budget
+		self._spill = spill
+		self._references = OrderedDict()
+		# kept in access order, least recently used first
+		self._sizes = {}
+		self._pinned = set()
+		self._entries = {}
+		# id -> [type, owner, created, accessed]
+		self._usage = 0
+		self._lock = threading.RLock()
+
+	@classmethod
+	def estimate(cls, value, depth = 3):
+		size = sys.getsizeof(value)
+		if depth == 0:
+			return size
+		if isinstance(value, dict):
+			children = value.iteritems()
+		elif isinstance(value, cls.containers):
+			children = iter(value)
+		elif hasattr(value, '__dict__'):
+			return size + cls.estimate(value.__dict__, depth - 1)
+		else:
+			return size
+		if not value:
+			return size
+		sampled = list(itertools.islice(children, cls.sample))
+		sampled_size = sum(cls.estimate(child, depth - 1) for child in sampled)
+		return size + sampled_size * len(value) // len(sampled)
+
+	def store(self, value, pinned = False, owner = None):
+		# pinned entries (exports) are never counted nor spilled
+		size = 0 if pinned else self.estimate(value)
+		id = uuid.uuid4()
+		now = time.time()
+		with self._lock:
+			self._reserve(size)
+			self._references[id] = value
+			self._sizes[id] = size
+			self._entries[id] = [getattr(value, '__class__', type(value)),
+								 owner, now, now]
+			self._usage += size
+			if pinned:
+				self._pinned.add(id)
+		return id
+
+	def access(self, id):
+		with self._lock:
+			if id in self._references:
+				value = self._references.pop(id)
+				self._references[id] = value
+				self._entries[id][3] = time.time()
+				return value
+			if self._spill is None or id not in self._spill:
+				raise KeyError(id)
+			self._reserve(self._sizes[id])
+			value = self._spill.take(id)
+			self._references[id] = value
+			self._entries[id][3] = time.time()
+			self._usage += self._sizes[id]
+			return value
+
+	def release(self, id):
+		with self._lock:
+			if id in self._references:
+				del self._references[id]
+				self._usage -= self._sizes.pop(id)
+				self._pinned.discard(id)
+			elif self._spill is not None and id in self._spill:
+				self._spill.discard(id)
+				del self._sizes[id]
+			else:
+				raise KeyError(id)
+			del self._entries[id]
+
+	def _reserve(self, size):
+		if self._budget is None or self._usage + size <= self._budget:
+			return
+		if self._spill is not None and size <= self._budget:
+			for id in list(self._references):
+				if self._usage + size <= self._budget:
+					break
+				if id not in self._pinned:
+					self._spill_entry(id)
+		if self._usage + size > self._budget:
+			raise MemoryBudgetError("Memory budget of %d bytes exceeded "
+									"(%d used, %d requested)"
+									% (self._budget, self._usage, size))
+
+	def _spill_entry(self, id):
+		if not self._detached(id):
+			return
+		self._spill.put(id, self._references.pop(id))
+		self._usage -= self._sizes[id]
+
+	def _detached(self, id):
+		# values referenced from elsewhere cannot be spilled, reloaded copy
+		# would silently diverge from the original
+		pending = [self._references[id]]
+		while pending:
+			current = pending.pop()
+			if isinstance(current, self.atoms):
+				continue
+			if type(current) not in self.containers:
+				return False
+			# owner, current local variable and getrefcount argument
+			if sys.getrefcount(current) > 3:
+				return False
+			if isinstance(current, dict):
+				pending.extend(current.iterkeys())
+				pending.extend(current.itervalues())
+			else:
+				pending.extend(current)
+		return True
+
+	def usage(self):
+		return self._usage
+
+	ages = (1, 10, 60, 600, 3600, 86400)
+	# upper bounds of age histogram buckets, in seconds
+
+	def introspect(self, top = 10, sample = 1000):
+		# groups are extrapolated from random sample of large tables, largest
+		# entries are those of the sample; only sampled entries are read
+		# under lock, dict.keys copies ids in single step
+		now = time.time()
+		ids = self._entries.keys()
+		total = len(ids)
+		if total > sample:
+			ids = random.sample(ids, sample)
+		sampled = []
+		with self._lock:
+			for id in ids:
+				entry = self._entries.get(id)
+				if entry is None:
+					# released meanwhile
+					continue
+				sampled.append((id, entry[:], self._sizes[id],
+								self._references.get(id) if id in self._pinned
+								else None, id not in self._references))
+			usage = self._usage
+			spilled = len(self._sizes) - len(self._references)
+		scale = float(total) / len(sampled) if sampled else 0.0
+		largest = heapq.nlargest(top, sampled, key = operator.itemgetter(2))
+		by_type = {}
+		by_owner = {}
+		age = dict((self.bucket(bound), 0) for bound in self.ages + (None,))
+		idle = dict(age)
+		for _id, entry, size, export, _spilled in sampled:
+			value_class, owner, created, accessed = entry
+			if export is not None:
+				# exports are not counted in budget, estimated only here
+				size = self.estimate(export)
+			owner = str(owner) if owner is not None else 'local'
+			for groups, key in ((by_type, self.type_name(value_class)),
+								(by_owner, owner)):
+				group = groups.setdefault(key, {'count': 0, 'size': 0})
+				group['count'] += 1
+				group['size'] += size
+			age[self.bucket(self.bound(now - created))] += 1
+			idle[self.bucket(self.bound(now - accessed))] += 1
+		for groups in (by_type, by_owner):
+			for group in groups.itervalues():
+				group['count'] = int(round(group['count'] * scale))
+				group['size'] = int(round(group['size'] * scale))
+		for histogram in (age, idle):
+			for key in histogram:
+				histogram[key] = int(round(histogram[key] * scale))
+		return {
+			'total': total,
+			'sampled': len(sampled),
+			'memory': usage,
+			'spilled': spilled,
+			'by_type': by_type,
+			'by_owner': by_owner,
+			'age': age,
+			'idle': idle,
+			'largest': [{
+				'id': id.hex,
+				'size': size,
+				'type': self.type_name(entry[0]),
+				'owner': entry[1],
+				'age': int(now - entry[2]),
+				'idle': int(now - entry[3]),
+				'spilled': spilled_entry,
+			} for id, entry, size, _export, spilled_entry in largest],
+		}
+
+	@classmethod
+	def bound(cls, seconds):
+		for bound in cls.ages:
+			if seconds < bound:
+				return bound
+		return None
+
+	@classmethod
+	def bucket(cls, bound):
+		return '<%ds' % bound if bound is not None else 'older'
+
+	@classmethod
+	def type_name(cls, value_class):
+		return value_class.__module__ + '.' + value_class.__name__
+
+	def __contains__(self, id):
+		return id in self._references or (self._spill is not None
+										  and id in self._spill)
+
+	def __len__(self):
+		return len(self._sizes)
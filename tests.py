@@ -6,7 +6,15 @@ import logging
 logging.basicConfig(level = logging.DEBUG)
 
 from remoteable.server import ThreadedRemotingServer
-from remoteable.client import RemotingClient
+from remoteable.client import RemotingClient, Attribute, Method, Callback
+from remoteable.tracing import Tracer
+from remoteable.transport import Channel, ZlibCompressor
+from remoteable.storage import ReferenceTable, SpillStore, MemoryBudgetError
+from remoteable.response import ServerBusyError, DeadlineExceededError
+from remoteable.server import RemotingActual, cacheable, Topic, Admission
+from remoteable import loadgen
+from remoteable.capture import Recorder, Replayer, read_log
+from remoteable import profiling
 
 
 class TestClass(object):
@@ -21,7 +29,45 @@ class TestClass(object):
 		return self.value
 
 
+class LookupClass(object):
+	def __init__(self):
+		self.calls = 0
+
+	@cacheable
+	def lookup(self, key):
+		self.calls += 1
+		return key * 2
+
+	def uncached(self, key):
+		self.calls += 1
+		return key * 2
+
+
+class Node(object):
+	def __init__(self, value, parent = None):
+		self.value = value
+		self.parent = parent
+		self._children = []
+
+	def add_child(self, node):
+		node.parent = self
+		self._children.append(node)
+
+
+class Point(object):
+	__slots__ = ('x', 'y')
+
+	def __init__(self, x, y):
+		self.x = x
+		self.y = y
+
+
+import time
 import random
+import pstats
+import tempfile
+import socket
+import threading
 
 class Test(unittest.TestCase):
 	def setUp(self):
@@ -34,6 +80,13 @@ class Test(unittest.TestCase):
 		if self.server.isAlive():
 			self.server.stop()
 
+	def serve(self, **kwargs):
+		address = ('localhost', random.randint(20001, 30000))
+		server = ThreadedRemotingServer(address, **kwargs)
+		server.start()
+		self.addCleanup(server.stop)
+		return server, address
+
 	def test_attribute(self):
 		base = 20
 		remote_name = 'obj'
@@ -129,5 +182,729 @@ class Test(unittest.TestCase):
 		self.assertRaises(KeyError, remote_object)
 		# test if server is wiped
 
+	def test_tracing(self):
+		exported = []
+		tracer = Tracer(exporter = exported.append)
+		server, address = self.serve()
+		client = RemotingClient(address, tracer = tracer)
+		server.export(TestClass(20), remote_name = 'obj')
+		with tracer.trace() as trace_id:
+			remote_object = client.fetch('obj')
+			self.assertEqual(int(remote_object.value), 20)
+		spans = tracer.spans()
+		self.assertEqual([span.serial for span in spans[:4]],
+						 ['fetch', 'describe', 'attribute-get', 'evaluate'])
+		self.assertEqual(exported, spans)
+		for span in spans:
+			self.assertEqual(span.trace_id, trace_id)
+			self.assertTrue('network' in span.timings)
+			self.assertTrue('execute' in span.remote_timings)
+			self.assertTrue('queue' in span.remote_timings)
+
+	def test_tracing_sampling(self):
+		tracer = Tracer(sample_rate = 0.0)
+		_server, address = self.serve()
+		client = RemotingClient(address, tracer = tracer)
+		self.assertEqual(int(client.store(30)), 30)
+		self.assertEqual(tracer.spans(), [])
+
+	def test_tracing_sampling_per_trace(self):
+		tracer = Tracer(sample_rate = 0.5)
+		server, address = self.serve()
+		client = RemotingClient(address, tracer = tracer)
+		server.export(TestClass(20), remote_name = 'obj')
+		for _trace in range(10):
+			tracer.clear()
+			with tracer.trace():
+				remote_object = client.fetch('obj')
+				self.assertEqual(int(remote_object.value), 20)
+			serials = [span.serial for span in tracer.spans()
+					   if span.serial != 'release']
+			# whole chain or nothing
+			self.assertTrue(serials == [] or ('fetch' in serials
+											  and 'evaluate' in serials))
+
+	def test_method_single_round_trip(self):
+		tracer = Tracer()
+		server, address = self.serve()
+		client = RemotingClient(address, tracer = tracer)
+		local_object = TestClass(20)
+		server.export(local_object, remote_name = 'obj')
+		remote_object = client.fetch('obj')
+		first = remote_object.method(5)
+		second = remote_object.method(5)
+		self.assertEqual(int(second), 30)
+		serials = [span.serial for span in tracer.spans()
+				   if span.serial != 'release']
+		self.assertEqual(serials[:4],
+						 ['fetch', 'describe', 'method-call', 'method-call'])
+		self.assertEqual(local_object.value, 30)
+		del first
+
+	def test_method_missing(self):
+		class Changing(object):
+			def method(self):
+				return 1
+
+		self.server.export(Changing(), remote_name = 'changing')
+		remote_object = self.client.fetch('changing')
+		self.assertEqual(int(remote_object.method()), 1)
+		del Changing.method
+		with self.assertRaises(AttributeError):
+			remote_object.method()
+
+	def test_method_as_value(self):
+		base = 20
+		local_object = TestClass(base)
+		self.server.export(local_object, remote_name = 'obj')
+		remote_object = self.client.fetch('obj')
+		method = self.client.store(remote_object.get_value)
+		self.assertEqual(int(method()), base)
+
+	def test_collect(self):
+		local_objects = [TestClass(value) for value in range(10)]
+		self.server.export(local_objects, remote_name = 'objects')
+		self.server.export(lambda value: value % 2 == 0, remote_name = 'even')
+		remote_objects = self.client.fetch('objects')
+		even = self.client.fetch('even')
+		self.assertEqual(self.client.map(Attribute('value'), remote_objects,
+										 evaluate = True), range(10))
+		values = self.client.map(Method('method', 1), remote_objects)
+		self.assertEqual(list(values), range(1, 11))
+		self.assertEqual(list(self.client.filter(even, values)), range(2, 11, 2))
+		total = self.client.collect(remote_objects, mapper = Attribute('value'),
+									predicate = even, reducer = 'addition',
+									initial = 100)
+		self.assertEqual(int(total), 100 + sum(range(2, 11, 2)))
+
+	def test_stream(self):
+		base = range(25)
+		remote_object = self.client.store(base)
+		self.assertEqual(list(self.client.stream(remote_object, size = 10)), base)
+
+	def test_stream_objects(self):
+		self.server.export([TestClass(value) for value in range(25)],
+						   remote_name = 'objects')
+		self.server.export([1, TestClass(2)], remote_name = 'mixed')
+		remote_objects = self.client.fetch('objects')
+		streamed = list(self.client.stream(remote_objects, size = 10))
+		self.assertEqual([int(item.value) for item in streamed], range(25))
+		collected = self.client.collect(remote_objects, evaluate = True)
+		self.assertEqual([int(item.value) for item in collected], range(25))
+		mixed = self.client.fetch('mixed')
+		first, second = self.client.collect(mixed, evaluate = True)
+		self.assertEqual((first, int(second.value)), (1, 2))
+
+	def test_memory_budget(self):
+		_server, address = self.serve(memory_budget = 50000)
+		client = RemotingClient(address)
+		small = client.store(range(10))
+		self.assertRaises(MemoryBudgetError, client.store, range(10000))
+		self.assertEqual(list(small), range(10))
+
+	def test_memory_spill(self):
+		server, address = self.serve(memory_budget = 100000, spill = True)
+		client = RemotingClient(address)
+		bases = [['value %d' % i] * 1000 for i in range(10)]
+		remote_objects = [client.store(base) for base in bases]
+		self.assertTrue(server._references.usage() <= 100000)
+		for base, remote_object in zip(bases, remote_objects):
+			self.assertEqual(list(remote_object), base)
+
+	def test_memory_spill_shared(self):
+		spill = SpillStore()
+		table = ReferenceTable(budget = 70000, spill = spill)
+		shared = range(1000)
+		holder = [shared]
+		shared_id = table.store(shared)
+		del shared
+		detached_id = table.store(range(1000))
+		table.store(range(1000))
+		self.assertTrue(detached_id in spill)
+		self.assertFalse(shared_id in spill)
+		self.assertTrue(table.access(shared_id) is holder[0])
+		self.assertRaises(MemoryBudgetError, table.store, range(10000))
+
+	def test_connection_limit(self):
+		_server, address = self.serve(max_connections = 1)
+		first = RemotingClient(address)
+		self.assertEqual(int(first.store(1)), 1)
+		rejected = RemotingClient(address, retries = 0)
+		self.assertRaises(ServerBusyError, rejected.store, 2)
+		threads = threading.active_count()
+		idle = [socket.create_connection(address) for _idle in range(5)]
+		time.sleep(0.1)
+		# connections over limit do not get handler threads
+		self.assertEqual(threading.active_count(), threads)
+		for connection in idle:
+			connection.close()
+		second = RemotingClient(address, retries = 10)
+		first._socket.close()
+		self.assertEqual(int(second.store(2)), 2)
+
+	def test_in_flight_limit(self):
+		server, address = self.serve(max_in_flight = 1, max_queued = 0)
+		server.export(lambda: time.sleep(0.5), remote_name = 'slow')
+		slow = RemotingClient(address).fetch('slow')
+		thread = threading.Thread(target = lambda: slow())
+		thread.start()
+		time.sleep(0.1)
+		busy = RemotingClient(address, retries = 0)
+		self.assertRaises(ServerBusyError, busy.store, 1)
+		patient = RemotingClient(address, retries = 10, backoff = 0.1)
+		self.assertEqual(int(patient.store(1)), 1)
+		thread.join()
+
+	def test_fair_scheduling(self):
+		class Session(object):
+			def __init__(self, priority):
+				self.priority = priority
+
+		admission = Admission(max_in_flight = 1)
+		batch, interactive = Session('batch'), Session('interactive')
+		admission.acquire(batch)
+		admission.release(batch, 1.0)
+		holder = Session(None)
+		admission.acquire(holder)
+		order = []
+
+		def run(session):
+			admission.acquire(session)
+			order.append(session.priority)
+			admission.release(session, 0.1)
+
+		threads = [threading.Thread(target = run, args = (session,))
+				   for session in (batch, interactive)]
+		for thread in threads:
+			thread.start()
+			time.sleep(0.05)
+		self.assertEqual(admission.load(), (1, 2))
+		admission.release(holder, 0.0)
+		for thread in threads:
+			thread.join()
+		self.assertEqual(order, ['interactive', 'batch'])
+
+	def test_priority_negotiation(self):
+		server, address = self.serve(max_in_flight = 2)
+		client = RemotingClient(address, priority = 'batch')
+		self.assertEqual(int(client.store(1)), 1)
+		sessions = [handler._session for handler in server._handlers]
+		self.assertEqual([session.priority for session in sessions], ['batch'])
+
+	def test_client_deadline(self):
+		self.server.export(lambda: time.sleep(0.5), remote_name = 'slow')
+		slow = self.client.fetch('slow')
+		with self.client.deadline(0.1):
+			self.assertRaises(DeadlineExceededError, slow)
+		self.assertEqual(int(self.client.store(1)), 1)
+
+	def test_server_deadline(self):
+		actual = RemotingActual('test')
+		actual.export(lambda: time.sleep(0.2), remote_name = 'slow')
+		slow = actual.fetch('slow')
+		command = {
+			'serial': 'execute',
+			'id': slow.hex,
+			'args': {'serial': 'tuple', 'data': []},
+			'kwargs': {'serial': 'dictionary', 'data': {}},
+		}
+		result = actual.process(dict(command, deadline = 0.1))
+		self.assertEqual(result['serial'], 'error-deadline')
+		self.assertEqual(len(actual._references), 1)
+		started = time.time()
+		result = actual.process(dict(command, deadline = 1), started - 2)
+		self.assertEqual(result['serial'], 'error-deadline')
+		self.assertTrue(time.time() - started < 0.2)
+
+	def test_server_deadline_evaluated(self):
+		actual = RemotingActual('test')
+		actual.export([1, 2, 3], remote_name = 'items')
+
+		def slow(value):
+			time.sleep(0.05)
+			return TestClass(value)
+
+		actual.export(slow, remote_name = 'slow')
+		items, mapper = actual.fetch('items'), actual.fetch('slow')
+		result = actual.process({
+			'serial': 'collect',
+			'id': items.hex,
+			'evaluate': True,
+			'mapper': {'serial': 'handle', 'id': mapper.hex},
+		}, time.time(), None)
+		self.assertEqual(len(actual._references), 5)
+		result = actual.process({
+			'serial': 'collect',
+			'id': items.hex,
+			'evaluate': True,
+			'mapper': {'serial': 'handle', 'id': mapper.hex},
+			'deadline': 0.1,
+		})
+		self.assertEqual(result['serial'], 'error-deadline')
+		# handles of evaluated elements are released with the result
+		self.assertEqual(len(actual._references), 5)
+
+	def test_memoization(self):
+		calls = []
+		def square(value):
+			calls.append(value)
+			return value ** 2
+		self.server.export(square, remote_name = 'square', cacheable = True)
+		remote_square = self.client.fetch('square')
+		self.assertEqual([int(remote_square(3)) for _ in range(3)], [9] * 3)
+		self.assertEqual(int(remote_square(value = 4)), 16)
+		self.assertEqual(calls, [3, 4])
+		self.assertEqual(self.server.results.stats()['hits'], 2)
+		self.server.invalidate(square)
+		self.assertEqual(int(remote_square(3)), 9)
+		self.assertEqual(calls, [3, 4, 3])
+
+	def test_memoization_method(self):
+		local_object = LookupClass()
+		self.server.export(local_object, remote_name = 'obj')
+		remote_object = self.client.fetch('obj')
+		for _ in range(3):
+			self.assertEqual(int(remote_object.lookup(5)), 10)
+			self.assertEqual(int(remote_object.uncached(5)), 10)
+		self.assertEqual(local_object.calls, 4)
+
+	def test_memoization_ttl(self):
+		calls = []
+		server, address = self.serve(cache_ttl = 0.05)
+		server.export(calls.append, remote_name = 'append', cacheable = True)
+		remote_append = RemotingClient(address).fetch('append')
+		remote_append(1)
+		remote_append(1)
+		time.sleep(0.1)
+		remote_append(1)
+		self.assertEqual(calls, [1, 1])
+
+	def test_client_cache(self):
+		tracer = Tracer()
+		server, address = self.serve()
+		local_object = TestClass(20)
+		server.export(local_object, remote_name = 'obj', cacheable = True)
+		client = RemotingClient(address, tracer = tracer, cache = True)
+		remote_object = client.fetch('obj')
+		self.assertEqual(int(remote_object.value), 20)
+		tracer.clear()
+		self.assertEqual(int(remote_object.value), 20)
+		self.assertEqual(str(remote_object.value), '20')
+		self.assertEqual(tracer.spans(), [])
+		remote_object.value = 30
+		self.assertEqual(int(remote_object.value), 30)
+
+	def test_client_cache_invalidation(self):
+		server, address = self.serve()
+		local_object = TestClass(20)
+		server.export(local_object, remote_name = 'obj', cacheable = True)
+		cached = RemotingClient(address, cache = True).fetch('obj')
+		other = RemotingClient(address).fetch('obj')
+		self.assertEqual(int(cached.value), 20)
+		other.value = 30
+		time.sleep(0.1)
+		self.assertEqual(int(cached.value), 30)
+		local_object.value = 40
+		self.assertEqual(int(cached.value), 30)
+		server.invalidate(local_object)
+		time.sleep(0.1)
+		self.assertEqual(int(cached.value), 40)
+
+	def test_client_cache_release(self):
+		server, address = self.serve()
+		local_object = TestClass(20)
+		local_object.children = [TestClass(1)]
+		server.export(local_object, remote_name = 'obj', cacheable = True)
+		client = RemotingClient(address, cache = True)
+		for _fetch in range(10):
+			remote_object = client.fetch('obj')
+			self.assertEqual(int(remote_object.value), 20)
+			del remote_object
+		client.store(0)
+		# released handles are no longer watched nor cached
+		self.assertEqual(len(server._watched), 0)
+		self.assertEqual(len(client._values), 0)
+		remote_object = client.fetch('obj')
+		self.assertRaises(TypeError, list, remote_object.children)
+		self.assertEqual(int(remote_object.value), 20)
+
+	def test_callback(self):
+		server, address = self.serve()
+		local_object = TestClass(20)
+		server.export(lambda function, value: function(value) + 1,
+					  remote_name = 'apply')
+		server.export(lambda function: function(local_object),
+					  remote_name = 'visit')
+		client = RemotingClient(address)
+		apply = client.fetch('apply')
+		self.assertEqual(int(apply(Callback(lambda value: value * 2), 5)), 11)
+		visit = client.fetch('visit')
+		self.assertEqual(int(visit(Callback(lambda obj: obj.value))), 20)
+		with self.assertRaises(ZeroDivisionError):
+			apply(Callback(lambda value: value / 0), 5)
+
+	def test_callback_while_queued(self):
+		server, address = self.serve(max_in_flight = 1)
+		stored = []
+		server.export(stored.append, remote_name = 'register')
+		server.export(lambda: stored[0](5) + 1, remote_name = 'fire')
+		server.export(lambda: time.sleep(0.3), remote_name = 'slow')
+		owner = RemotingClient(address)
+		owner.fetch('register')(Callback(lambda value: value * 2))
+		slow = RemotingClient(address).fetch('slow')
+		fire = RemotingClient(address).fetch('fire')
+		results = []
+		threads = [threading.Thread(target = slow),
+				   threading.Thread(target = lambda: results.append(int(fire())))]
+		for thread in threads:
+			thread.start()
+			time.sleep(0.05)
+		# owner of callback waits for admission while it is called back
+		self.assertEqual(int(owner.store(1)), 1)
+		for thread in threads:
+			thread.join(5)
+			self.assertFalse(thread.isAlive())
+		self.assertEqual(results, [11])
+
+	def test_pipelined_while_queued(self):
+		server, address = self.serve(max_in_flight = 1)
+		running = [0, 0]
+
+		def slow():
+			running[0] += 1
+			running[1] = max(running)
+			time.sleep(0.2)
+			running[0] -= 1
+
+		server.export(slow, remote_name = 'slow')
+		channel = Channel(socket.create_connection(address))
+		self.addCleanup(channel.close)
+		channel.send({'serial': 'fetch', 'name': 'slow'})
+		slow_id = channel.receive()[0]['id']
+		execute = {
+			'serial': 'execute',
+			'id': slow_id,
+			'args': {'serial': 'tuple', 'data': []},
+			'kwargs': {'serial': 'dictionary', 'data': {}},
+		}
+		thread = threading.Thread(target = RemotingClient(address).fetch('slow'))
+		thread.start()
+		time.sleep(0.05)
+		channel.send(execute)
+		channel.send(execute)
+		channel.send({'serial': 'fetch', 'name': 'missing'})
+		serials = [channel.receive()[0]['serial'] for _response in range(3)]
+		thread.join()
+		self.assertEqual(serials, ['handle', 'handle', 'error-access'])
+		# pipelined commands were admitted one by one
+		self.assertEqual(running[1], 1)
+
+	def test_callback_deadline(self):
+		server, address = self.serve(max_in_flight = 1)
+		stored = []
+		server.export(stored.append, remote_name = 'register')
+		server.export(lambda: stored[0](), remote_name = 'fire')
+		owner = RemotingClient(address)
+		owner.fetch('register')(Callback(lambda: None))
+		# owner does not read its connection, callback is never answered
+		fire = RemotingClient(address, timeout = 0.3).fetch('fire')
+		self.assertRaises(DeadlineExceededError, fire)
+		self.assertEqual(int(RemotingClient(address).store(1)), 1)
+
+	def test_topic(self):
+		server, address = self.serve()
+		topic = Topic()
+		server.export(topic, remote_name = 'topic')
+		client = RemotingClient(address)
+		received = []
+		callback = Callback(received.append)
+		remote_topic = client.fetch('topic')
+		remote_topic.subscribe(callback)
+		remote_topic.subscribe(callback)
+		self.assertEqual(len(topic), 1)
+		topic.publish('first')
+		self.assertTrue(client.listen(1))
+		self.assertEqual(received, ['first'])
+		remote_topic.unsubscribe(callback)
+		topic.publish('second')
+		self.assertFalse(client.listen(0.1))
+		self.assertEqual(received, ['first'])
+
+	def test_snapshot(self):
+		root = Node(1)
+		for value in range(3):
+			child = Node(value)
+			child.add_child(Node(Point(value, value)))
+			root.add_child(child)
+		root.shared = {'first': root._children[0], 'tags': ('a', 'b')}
+		self.server.export(root, remote_name = 'root')
+		remote_root = self.client.fetch('root')
+		snapshot = self.client.snapshot(remote_root)
+		self.assertEqual(snapshot.value, 1)
+		self.assertEqual(len(snapshot._children), 3)
+		first = snapshot._children[0]
+		self.assertTrue(first.parent is snapshot)
+		self.assertTrue(snapshot.shared['first'] is first)
+		self.assertEqual(snapshot.shared['tags'], ('a', 'b'))
+		self.assertEqual(first._children[0].value.y, 0)
+
+	def test_snapshot_limits(self):
+		root = Node(1)
+		root.add_child(Node(TestClass(2)))
+		self.server.export(root, remote_name = 'root')
+		remote_root = self.client.fetch('root')
+		snapshot = self.client.snapshot(remote_root, depth = 3,
+										exclude = ['parent'])
+		self.assertFalse(hasattr(snapshot, 'parent'))
+		child = snapshot._children[0]
+		self.assertFalse(hasattr(child, 'parent'))
+		self.assertEqual(int(child.value.value), 2)
+
+	def test_introspection(self):
+		server, address = self.serve()
+		server.export(TestClass(1), remote_name = 'obj')
+		client = RemotingClient(address)
+		other = RemotingClient(address)
+		exported = client.fetch('obj')
+		stored = [client.store(range(1000))] + \
+			[other.store('value %d' % i) for i in range(3)]
+		report = client.introspect(top = 2)
+		self.assertEqual(report['total'], 5)
+		self.assertEqual(report['by_type']['__builtin__.str']['count'], 3)
+		self.assertEqual(report['by_type']['remoteable.tests.TestClass']['count'], 1)
+		self.assertEqual(sorted(group['count']
+								for group in report['by_owner'].values()), [2, 3])
+		self.assertEqual(report['age']['<1s'], 5)
+		self.assertEqual(len(report['largest']), 2)
+		self.assertEqual(report['largest'][0]['type'], '__builtin__.list')
+		del exported, stored
+
+	def test_introspection_sampling(self):
+		table = ReferenceTable()
+		for i in range(500):
+			table.store([i] if i % 5 else str(i))
+		report = table.introspect(sample = 100)
+		self.assertEqual(report['total'], 500)
+		self.assertEqual(report['sampled'], 100)
+		self.assertEqual(sum(group['count']
+							 for group in report['by_type'].values()), 500)
+		self.assertEqual(report['idle']['<1s'], 500)
+		self.assertEqual(len(report['largest']), 10)
+		self.assertEqual(report['largest'][0]['type'], '__builtin__.list')
+
+	def test_container(self):
+		mapping = {'a': 1, 'b': 2, 'node': TestClass(3)}
+		self.server.export(mapping, remote_name = 'mapping')
+		remote_mapping = self.client.fetch('mapping')
+		self.assertEqual(len(remote_mapping), 3)
+		self.assertTrue('a' in remote_mapping)
+		self.assertFalse('c' in remote_mapping)
+		self.assertEqual(sorted(remote_mapping.keys()), ['a', 'b', 'node'])
+		items = dict(remote_mapping.items())
+		self.assertEqual(items['a'], 1)
+		self.assertEqual(int(items['node'].value), 3)
+		self.assertEqual(self.client.get_many(remote_mapping, ['b', 'a']), [2, 1])
+		self.client.set_many(remote_mapping, {'a': 10, 'c': 30})
+		self.assertEqual(mapping['a'], 10)
+		self.assertEqual(mapping['c'], 30)
+
+	def test_container_slice(self):
+		base = range(10)
+		self.server.export(base, remote_name = 'list')
+		remote_list = self.client.fetch('list')
+		part = remote_list[2:8:2]
+		self.assertEqual(len(part), 3)
+		self.assertEqual(list(part), [2, 4, 6])
+		self.assertEqual(self.client.slice(remote_list, -3), [7, 8, 9])
+		self.server.export(5, remote_name = 'five')
+		with self.assertRaises(TypeError):
+			len(self.client.fetch('five'))
+
+	def test_capture_replay(self):
+		log = tempfile.NamedTemporaryFile(suffix = '.log')
+		self.addCleanup(log.close)
+		recorder = Recorder(log.name)
+		server, address = self.serve(recorder = recorder)
+		server.export(TestClass(20), remote_name = 'obj')
+		client = RemotingClient(address)
+		remote_object = client.fetch('obj')
+		remote_object.value = client.store([1, 2])
+		self.assertEqual(list(remote_object.value), [1, 2])
+		other = RemotingClient(address).fetch('obj')
+		self.assertEqual(int(other.get_value()[0]), 1)
+		recorder.flush()
+		records = read_log(log.name)
+		self.assertEqual(len(set(record['c'] for record in records)), 2)
+
+		replayed = TestClass(0)
+		fresh, fresh_address = self.serve()
+		fresh.export(replayed, remote_name = 'obj')
+		report = Replayer(fresh_address, records, speed = None).run()
+		self.assertEqual(report['commands'], len(records))
+		self.assertEqual(report['errors'], 0)
+		self.assertEqual(replayed.value, [1, 2])
+
+	def test_capture_replay_write_behind(self):
+		log = tempfile.NamedTemporaryFile(suffix = '.log')
+		self.addCleanup(log.close)
+		recorder = Recorder(log.name)
+		server, address = self.serve(recorder = recorder)
+		server.export(TestClass, remote_name = 'make')
+		client = RemotingClient(address)
+		created = client.write_behind(client.fetch('make')(0))
+		created.value = 5
+		client.flush()
+		recorder.flush()
+		records = read_log(log.name)
+		self.assertEqual(records[-1]['d']['serial'], 'write-batch')
+
+		replayed = []
+		fresh, fresh_address = self.serve()
+		fresh.export(lambda value: replayed.append(TestClass(value))
+					 or replayed[-1], remote_name = 'make')
+		report = Replayer(fresh_address, records, speed = None).run()
+		self.assertEqual(report['errors'], 0)
+		self.assertEqual(replayed[0].value, 5)
+
+	def test_write_behind(self):
+		local_object = TestClass(0)
+		mapping = {}
+		self.server.export(local_object, remote_name = 'obj')
+		self.server.export(mapping, remote_name = 'mapping')
+		remote_object = self.client.write_behind(self.client.fetch('obj'))
+		remote_mapping = self.client.write_behind(self.client.fetch('mapping'))
+		remote_list = self.client.store([1, 2])
+		for i in range(10):
+			remote_object.value = i
+			remote_mapping[i % 3] = i
+		remote_object.other = remote_list
+		del remote_list
+		self.assertEqual(local_object.value, 0)
+		self.assertEqual(mapping, {})
+		self.assertEqual(len(self.client._writes), 5)
+		self.assertEqual(int(remote_object.value), 9)
+		self.assertEqual(mapping, {0: 9, 1: 7, 2: 8})
+		self.assertEqual(local_object.other, [1, 2])
+
+	def test_write_behind_dropped(self):
+		local_object = TestClass(0)
+		self.server.export(local_object, remote_name = 'obj')
+		for i in range(3):
+			self.client.write_behind(self.client.fetch('obj')).value = i
+		# each fetch flushed previous write, last dropped handle is kept
+		# alive by its pending write
+		self.assertEqual(len(self.client._writes), 1)
+		self.assertEqual(self.server.stats()['handles'], 1)
+		self.client.flush()
+		self.assertEqual(local_object.value, 2)
+		self.client.store(0)
+		self.assertEqual(self.server.stats()['handles'], 0)
+
+	def test_write_behind_flush(self):
+		self.server.export(5, remote_name = 'five')
+		self.server.export(TestClass(0), remote_name = 'obj')
+		unrelated = self.client.store(1)
+		five = self.client.write_behind(self.client.fetch('five'))
+		handles = self.server.stats()['handles']
+		five.value = 1
+		# releasing does not flush, so error is not lost in __del__
+		del unrelated
+		self.assertEqual(self.server.stats()['handles'], handles - 1)
+		self.assertEqual(len(self.client._writes), 1)
+		self.assertRaises(AttributeError, self.client.flush)
+		remote_object = self.client.write_behind(self.client.fetch('obj'),
+												 max_pending = 2)
+		remote_object.a = 1
+		self.assertEqual(len(self.client._writes), 1)
+		remote_object.b = 2
+		self.assertEqual(len(self.client._writes), 0)
+
+	def profile_workload(self, mode):
+		server, address = self.serve()
+
+		def busy_work():
+			deadline = time.time() + 0.02
+			while time.time() < deadline:
+				pass
+
+		server.export(busy_work, remote_name = 'busy_work')
+		running = [True]
+
+		def load():
+			function = RemotingClient(address).fetch('busy_work')
+			while running[0]:
+				function()
+
+		thread = threading.Thread(target = load)
+		thread.start()
+		try:
+			return RemotingClient(address).profile(0.3, mode)
+		finally:
+			running[0] = False
+			thread.join()
+
+	def test_profile(self):
+		report = self.profile_workload('deterministic')
+		self.assertTrue(report['by_serial']['execute']['calls'] > 0)
+		# exported callable ranks first, standard library is left out
+		self.assertTrue('busy_work' in report['callables'][0]['function'])
+		self.assertFalse(any(function['function'].startswith(profiling.STDLIB)
+							 for function in report['callables']))
+		output = tempfile.NamedTemporaryFile(suffix = '.prof')
+		self.addCleanup(output.close)
+		profiling.save(report, output.name)
+		stats = pstats.Stats(output.name)
+		self.assertTrue(any(name == 'busy_work'
+							for _file, _line, name in stats.stats))
+		# receiving and sending frames is attributed too
+		names = set(name for _file, _line, name in stats.stats)
+		self.assertTrue('receive_payload' in names and 'send_frame' in names)
+
+	def test_profile_sampling(self):
+		report = self.profile_workload('sampling')
+		self.assertTrue(report['by_serial']['execute'] > 0)
+		self.assertTrue(any('busy_work' in function['function']
+							for function in report['callables']))
+		self.assertTrue(report['folded'].startswith('execute;'))
+		with self.assertRaises(ValueError):
+			self.server.profile(0.01, 'unknown')
+
+	def test_load_generator(self):
+		server, address = self.serve()
+		loadgen.export_samples(server, depth = 3, fanout = 2)
+		options = {'payload_size': 10, 'tree_depth': 3, 'fanout': 2}
+		summary = loadgen.run_level(server, address, 2, 0.5,
+									loadgen.parse_mix('fetch,call=2,churn'),
+									options, interval = 0.25,
+									processes = False)
+		self.assertEqual(summary['clients'], 2)
+		self.assertEqual(summary['errors'], 0)
+		self.assertTrue(summary['operations'] > 0)
+		self.assertTrue(summary['scenarios']['call']['operations'] > 0)
+		self.assertTrue(summary['p50'] <= summary['p99'])
+		self.assertTrue(summary['timeline'])
+
+	def test_compression(self):
+		base = ['element %d' % i for i in range(5000)]
+		_server, address = self.serve(threshold = 256)
+		client = RemotingClient(address, compression = ['zlib'],
+								threshold = 256)
+		remote_object = client.store(base)
+		self.assertEqual(list(remote_object), base)
+
+	def test_compression_threshold(self):
+		first, second = socket.socketpair()
+		sender = Channel(first, ZlibCompressor(), threshold = 256)
+		receiver = Channel(second, ZlibCompressor())
+		large = {'data': ['x' * 10] * 1000}
+		sender.send(large)
+		flags, payload = receiver.receive_frame()
+		self.assertTrue(flags & Channel.COMPRESSED)
+		self.assertTrue(len(payload) < 256)
+		self.assertEqual(receiver.unpack(flags, payload), large)
+		sender.send({'data': 1})
+		flags, payload = receiver.receive_frame()
+		self.assertFalse(flags & Channel.COMPRESSED)
+
 if __name__ == "__main__":
 	unittest.main()
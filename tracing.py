@@ -0,0 +1,130 @@
+import time
+import uuid
+import random
+import threading
+
+from collections import deque
+from contextlib import contextmanager
+
+
+class NullSpan(object):
+	def mark(self, _stage, _now = None):
+		pass
+
+	def attach(self, data):
+		return data
+
+	def report(self):
+		return None
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(NullSpan):
+	def __init__(self, trace_id, id, serial, started = None):
+		NullSpan.__init__(self)
+		self.trace_id = trace_id
+		self.id = id
+		self.serial = serial
+		self.started = started if started is not None else time.time()
+		self.duration = None
+		self.timings = {}
+		self.remote_timings = {}
+		self._last = self.started
+
+	@classmethod
+	def resume(cls, context, started = None):
+		return cls(uuid.UUID(hex = context['trace']),
+				   uuid.UUID(hex = context['span']),
+				   context.get('serial'), started)
+
+	def mark(self, stage, now = None):
+		if now is None:
+			now = time.time()
+		self.timings[stage] = self.timings.get(stage, 0.0) + now - self._last
+		self._last = now
+
+	def context(self):
+		return {
+			'trace': self.trace_id.hex,
+			'span': self.id.hex,
+			'serial': self.serial,
+		}
+
+	def attach(self, data):
+		return dict(data, trace = self.context())
+
+	def report(self):
+		return {
+			'span': self.id.hex,
+			'timings': dict(self.timings, total = self._last - self.started),
+		}
+
+	def finish(self, report):
+		self.duration = self._last - self.started
+		if report is None:
+			return
+		self.remote_timings = dict(report['timings'])
+		# time spent on server is included in client-side network stage
+		if 'network' in self.timings:
+			self.timings['network'] -= self.remote_timings.get('total', 0.0)
+
+	def exported(self):
+		return {
+			'trace': self.trace_id.hex,
+			'span': self.id.hex,
+			'serial': self.serial,
+			'started': self.started,
+			'duration': self.duration,
+			'client': dict(self.timings),
+			'server': dict(self.remote_timings),
+		}
+
+	def __repr__(self):
+		return "<Span %s (%s)>" % (self.serial, self.id)
+
+
+class Tracer(object):
+	def __init__(self, sample_rate = 1.0, exporter = None, capacity = 1024):
+		self._sample_rate = sample_rate
+		self._exporter = exporter
+		self._spans = deque(maxlen = capacity)
+		self._local = threading.local()
+
+	def sampled(self):
+		return random.random() < self._sample_rate
+
+	def begin(self, serial):
+		trace_id = getattr(self._local, 'trace_id', None)
+		if trace_id is None:
+			if not self.sampled():
+				return NULL_SPAN
+			trace_id = uuid.uuid4()
+		elif not self._local.sampled:
+			return NULL_SPAN
+		return Span(trace_id, uuid.uuid4(), serial)
+
+	def finish(self, span):
+		self._spans.append(span)
+		if self._exporter is not None:
+			self._exporter(span)
+
+	@contextmanager
+	def trace(self):
+		# all commands pushed within block share a single trace id and are
+		# either all traced or none of them is
+		previous = (getattr(self._local, 'trace_id', None),
+					getattr(self._local, 'sampled', False))
+		self._local.trace_id = uuid.uuid4()
+		self._local.sampled = self.sampled()
+		try:
+			yield self._local.trace_id
+		finally:
+			self._local.trace_id, self._local.sampled = previous
+
+	def spans(self):
+		return list(self._spans)
+
+	def clear(self):
+		self._spans.clear()
@@ -0,0 +1,133 @@
+import json
+import zlib
+import struct
+import select
+import threading
+
+
+class TransportError(Exception):
+	pass
+
+
+class ConnectionClosed(TransportError):
+	pass
+
+
+class Compressor(object):
+	name = None
+
+	_registry = {}
+
+	@classmethod
+	def register(cls):
+		cls._registry[cls.name] = cls
+
+	@classmethod
+	def available(cls):
+		return sorted(cls._registry.keys())
+
+	@classmethod
+	def negotiate(cls, offered, accepted = None):
+		# first offered compressor known (and accepted) locally wins
+		for name in offered:
+			if name not in cls._registry:
+				continue
+			if accepted is not None and name not in accepted:
+				continue
+			return cls._registry[name]()
+		return None
+
+	def compress(self, payload):
+		raise NotImplementedError(self)
+
+	def decompress(self, payload):
+		raise NotImplementedError(self)
+
+
+class ZlibCompressor(Compressor):
+	name = 'zlib'
+
+	def __init__(self, level = 6):
+		Compressor.__init__(self)
+		self._level = level
+
+	def compress(self, payload):
+		return zlib.compress(payload, self._level)
+
+	def decompress(self, payload):
+		try:
+			return zlib.decompress(payload)
+		except zlib.error, ex:
+			raise ValueError(str(ex))
+
+
+ZlibCompressor.register()
+
+
+class Channel(object):
+	header = struct.Struct('!BI')
+
+	COMPRESSED = 0x01
+	CONTROL = 0x02
+
+	def __init__(self, socket, compressor = None, threshold = 1024):
+		self._socket = socket
+		self.compressor = compressor
+		self.threshold = threshold
+		self._sending = threading.Lock()
+
+	def pack(self, data, control = False):
+		payload = json.dumps(data)
+		flags = self.CONTROL if control else 0
+		if self.compressor is not None and len(payload) >= self.threshold:
+			payload = self.compressor.compress(payload)
+			flags |= self.COMPRESSED
+		return self.header.pack(flags, len(payload)) + payload
+
+	def unpack(self, flags, payload):
+		if flags & self.COMPRESSED:
+			if self.compressor is None:
+				raise ValueError("Compressed frame on uncompressed channel")
+			payload = self.compressor.decompress(payload)
+		return json.loads(payload)
+
+	def send_frame(self, frame):
+		with self._sending:
+			self._socket.sendall(frame)
+
+	def receive_frame(self):
+		flags, length = self.receive_header()
+		return flags, self.receive_payload(length)
+
+	def receive_header(self):
+		return self.header.unpack(self._read(self.header.size))
+
+	def receive_payload(self, length):
+		return self._read(length)
+
+	def send(self, data, control = False):
+		self.send_frame(self.pack(data, control))
+
+	def receive(self):
+		flags, payload = self.receive_frame()
+		return self.unpack(flags, payload), bool(flags & self.CONTROL)
+
+	def readable(self, timeout = 0):
+		return bool(select.select([self._socket], [], [], timeout)[0])
+
+	def _read(self, size):
+		chunks = []
+		remaining = size
+		while remaining:
+			chunk = self._socket.recv(min(remaining, 65536))
+			if not chunk:
+				raise ConnectionClosed()
+			chunks.append(chunk)
+			remaining -= len(chunk)
+		return ''.join(chunks)
+
+	def close(self):
+		self._socket.close()
+
+	def __repr__(self):
+		return "<%s socket(%s)>" % (self.__class__.__name__, self._socket)